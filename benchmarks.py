@@ -0,0 +1,369 @@
+#!/usr/bin/env python
+"""
+micro benchmarks for the StateJournal
+
+usage: python benchmarks.py <benchmark> [num_updates]
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+from ethereum.utils import sha3, int_to_big_endian
+from db import LevelDB, codecs
+import statejournal
+import chainmock
+
+
+def get_updates(num_updates, num_keys=None):
+    num_keys = num_keys or num_updates
+    keys = [sha3(str(i)) for i in range(num_keys)]
+    return [(keys[i % num_keys], int_to_big_endian(i + 1)) for i in range(num_updates)]
+
+
+class tmpdb(object):
+    "context manager providing a LevelDB in a temporary directory"
+
+    def __init__(self, **db_args):
+        self.db_args = db_args
+
+    def __enter__(self):
+        self.path = tempfile.mkdtemp(prefix='sj_bench_')
+        return LevelDB(self.path, **self.db_args)
+
+    def __exit__(self, *args):
+        shutil.rmtree(self.path)
+
+
+def disk_usage(path):
+    "returns the on disk sizes of (leveldb files, journal files)"
+    sizes = [0, 0]
+    for fn in os.listdir(path):
+        is_journal = fn.startswith(statejournal.StateJournal.state_journal_fn)
+        sizes[is_journal] += os.path.getsize(os.path.join(path, fn))
+    return sizes
+
+
+def report(name, num_ops, elapsed):
+    print '%-32s %10d ops %8.3fs %12.0f ops/sec' % (name, num_ops, elapsed, num_ops / elapsed)
+
+
+def bench_update_many(num_updates=100000, commit_interval=10000):
+    "compares per key `update` with the buffered `update_many`"
+    updates = get_updates(num_updates)
+    blocks = [updates[i:i + commit_interval] for i in range(0, num_updates, commit_interval)]
+    digests = []
+    for name in ('update', 'update_many'):
+        with tmpdb() as db:
+            sj = statejournal.StateJournal(db)
+            st = time.time()
+            for block in blocks:
+                if name == 'update':
+                    for k, v in block:
+                        sj.update(k, v)
+                else:
+                    sj.update_many(block)
+                sj.commit()
+            report(name, num_updates, time.time() - st)
+            digests.append(sj.state_digest)
+    assert digests[0] == digests[1]
+
+
+def bench_readers(num_updates=100000):
+    "compares full journal scans of the file based and the mmap based JournalReader"
+    with tmpdb() as db:
+        sj = statejournal.StateJournal(db)
+        sj.update_many(get_updates(num_updates))
+        sj.commit()
+        for reader_class in (statejournal.JournalReader, statejournal.MmapJournalReader):
+            jr = reader_class(db)
+            st = time.time()
+            for uc in range(1, num_updates + 1):
+                jr.read_update(uc)
+            report(reader_class.__name__ + '.read_update', num_updates, time.time() - st)
+            st = time.time()
+            assert jr.validate_state(num_updates) == sj.state_digest
+            report(reader_class.__name__ + '.validate', num_updates, time.time() - st)
+
+
+def bench_ssv(num_updates=100000, num_proofs=100):
+    "compares linear SSVs with the O(log(n)) SSVs of the skiplist digest mode"
+    updates = get_updates(num_updates)
+    targets = range(1, num_updates, num_updates / num_proofs)
+    for digest_mode in statejournal.StateJournal.digest_modes:
+        with tmpdb() as db:
+            sj = statejournal.StateJournal(db, digest_mode=digest_mode)
+            st = time.time()
+            sj.update_many(updates)
+            sj.commit()
+            report(digest_mode + '.update', num_updates, time.time() - st)
+            jr = sj.get_reader()
+            hashes = 0
+            st = time.time()
+            for uc in targets:
+                if digest_mode == 'skiplist':
+                    hashes += len(jr.get_ssv_log(uc)['proof'])
+                else:
+                    hashes += len(jr.get_ssv(uc)['hash_chain'])
+            report(digest_mode + '.ssv', len(targets), time.time() - st)
+            print '%-32s %10d hashes/proof' % (digest_mode, hashes / len(targets))
+
+
+def bench_validate(num_updates=100000, processes=0):
+    "compares the serial validate_state with validate_state_parallel"
+    def progress(validated, total, elapsed):
+        print '  %5.1f%% %12.0f updates/sec' % (100. * validated / total, validated / elapsed)
+
+    with tmpdb() as db:
+        sj = statejournal.StateJournal(db)
+        sj.update_many(get_updates(num_updates))
+        sj.commit()
+        st = time.time()
+        assert sj.get_reader().validate_state(num_updates) == sj.state_digest
+        report('validate_state', num_updates, time.time() - st)
+        st = time.time()
+        r = statejournal.validate_state_parallel(db, num_updates, processes=processes or None,
+                                                 progress=progress)
+        assert r == sj.state_digest
+        report('validate_state_parallel', num_updates, time.time() - st)
+
+
+def bench_rollback(num_updates=100000, num_keys=10000):
+    "rolls back a block of num_updates updates to num_keys keys"
+    with tmpdb() as db:
+        sj = statejournal.StateJournal(db)
+        sj.update_many(get_updates(num_keys))
+        sj.commit()
+        sj.update_many(get_updates(num_updates, num_keys))
+        sj.commit()
+        st = time.time()
+        sj.rollback(num_keys)
+        report('rollback', num_updates, time.time() - st)
+        assert sj.update_counter == num_keys
+
+
+def bench_codecs(num_values=100000, num_accounts=100):
+    """
+    runs the chainmock create and read workloads for every value and key codec
+    and reports the on disk sizes after a compaction
+    """
+    accounts = [sha3(str(i)) for i in range(num_accounts)]
+    for tech in ('journal', 'trie'):
+        for value_codec in sorted(codecs):
+            for key_codec in ('none', 'zlib'):
+                path = tempfile.mkdtemp(prefix='sj_bench_')
+                try:
+                    get_chain = getattr(chainmock, 'get_%s_chain' % (
+                        'statejournal' if tech == 'journal' else 'trie'))
+                    chain = get_chain(path, value_codec=value_codec, key_codec=key_codec)
+                    name = '%s.%s.%s' % (tech, value_codec, key_codec)
+                    st = time.time()
+                    chainmock.test_writes(chain, accounts, num_values)
+                    chain.storage.commit()
+                    report(name + '.create', num_values, time.time() - st)
+                    ldb = chain.storage.db.db
+                    ldb.db.CompactRange()
+                    st = time.time()
+                    chainmock.test_reads(chain, accounts, num_values)
+                    report(name + '.read', num_values, time.time() - st)
+                    db_size, journal_size = disk_usage(path)
+                    print '%-32s %10d bytes db %10d bytes journal' % (name, db_size, journal_size)
+                finally:
+                    shutil.rmtree(path)
+
+
+def bench_entry_sizes(num_updates=100000, large_value_size=100000):
+    """
+    writes and reads small entries and 64KB+ entries.
+    small entries use the same encoding as before large entries were supported.
+    """
+    small = get_updates(num_updates)
+    num_large = max(1, num_updates / 100)
+    large = [(k, v * (large_value_size / len(v))) for k, v in get_updates(num_large)]
+    for name, updates in (('small', small), ('large', large)):
+        with tmpdb() as db:
+            sj = statejournal.StateJournal(db)
+            st = time.time()
+            sj.update_many(updates)
+            sj.commit()
+            report(name + '.update_many', len(updates), time.time() - st)
+            jr = sj.get_reader()
+            st = time.time()
+            for uc in range(1, len(updates) + 1):
+                jr.read_update(uc)
+            report(name + '.read_update', len(updates), time.time() - st)
+
+
+def bench_archive(num_updates=100000, num_reads=10000):
+    "sizes and random read latency of raw and archived segments for several block sizes"
+    import random
+    updates = get_updates(num_updates)
+    rnd = random.Random(0)
+    reads = [rnd.randint(1, num_updates / 2) for i in range(num_reads)]
+    for block_size in (0, 2**12, 2**14, 2**16, 2**18):
+        with tmpdb() as db:
+            sj = statejournal.StateJournal(db, segment_size=2**20)
+            sj.update_many(updates)
+            sj.commit()
+            name = 'archive.%d' % block_size if block_size else 'raw'
+            if block_size:
+                st = time.time()
+                stats = sj.archive(num_updates / 2, block_size=block_size)
+                report(name + '.archive', stats['segments'], time.time() - st)
+                print '%-32s %10d bytes raw %10d bytes archived %8d blocks' % (
+                    name, stats['raw_bytes'], stats['archived_bytes'], stats['blocks'])
+            jr = statejournal.MmapJournalReader(db)
+            st = time.time()
+            for uc in reads:
+                jr.read_update(uc)
+            elapsed = time.time() - st
+            report(name + '.read_update', num_reads, elapsed)
+
+
+def bench_durability(num_blocks=200, block_size=100):
+    "commit latency and throughput of the durability modes"
+    updates = get_updates(num_blocks * block_size)
+    for durability in ('none', 'flush', 'fsync', 'group'):
+        with tmpdb() as db:
+            sj = statejournal.StateJournal(db, durability=durability, group_commit_blocks=10)
+            latencies = []
+            st = time.time()
+            for i in range(0, len(updates), block_size):
+                sj.update_many(updates[i:i + block_size])
+                cst = time.time()
+                sj.commit()
+                latencies.append(time.time() - cst)
+            sj.sync()
+            report(durability + '.update', len(updates), time.time() - st)
+            latencies.sort()
+            print '%-32s %8.3fms p50 %8.3fms p99' % (
+                durability + '.commit', latencies[len(latencies) / 2] * 1000,
+                latencies[len(latencies) * 99 / 100] * 1000)
+
+
+def bench_pipelined(num_updates=200000, block_size=1000):
+    "compares serial writes with the pipelined JournalWriter, for the flush and fsync modes"
+    updates = get_updates(num_updates)
+    for durability in ('flush', 'fsync'):
+        for pipelined in (False, True):
+            with tmpdb() as db:
+                sj = statejournal.StateJournal(db, durability=durability, pipelined=pipelined)
+                st = time.time()
+                blocked = 0
+                for i in range(0, num_updates, block_size):
+                    sj.update_many(updates[i:i + block_size])
+                    cst = time.time()
+                    sj.commit()
+                    blocked += time.time() - cst
+                sj.close()
+                name = '%s.%s' % (durability, 'pipelined' if pipelined else 'serial')
+                report(name, num_updates, time.time() - st)
+                print '%-32s %8.3fs blocked in commit' % (name, blocked)
+
+
+def bench_hashing(num_hashes=200000):
+    "hashes/sec of every available keccak backend for digest and log sized inputs"
+    import hashing
+    for size in (64, 100, 1000):
+        data = ['%0*d' % (size, i) for i in range(num_hashes)]
+        for name, hash_fn in sorted(hashing.backends.items()):
+            st = time.time()
+            for d in data:
+                hash_fn(d)
+            report('%s.%d' % (name, size), num_hashes, time.time() - st)
+        st = time.time()
+        hashing.sha3_many(data)
+        report('sha3_many.%s.%d' % (hashing.backend, size), num_hashes, time.time() - st)
+
+
+def bench_get_at(num_updates=100000, num_keys=100, num_reads=1000):
+    "point in time reads of keys with num_updates / num_keys changes, with and without history"
+    import random
+    updates = get_updates(num_updates, num_keys)
+    rnd = random.Random(0)
+    reads = [(updates[rnd.randint(0, num_keys - 1)][0], rnd.randint(0, num_updates))
+             for i in range(num_reads)]
+    for history in (False, True):
+        with tmpdb() as db:
+            sj = statejournal.StateJournal(db, history=history)
+            st = time.time()
+            sj.update_many(updates)
+            sj.commit()
+            name = 'history' if history else 'journal'
+            report(name + '.update', num_updates, time.time() - st)
+            st = time.time()
+            for key, uc in reads:
+                sj.get_at(key, uc)
+            report(name + '.get_at', num_reads, time.time() - st)
+
+
+def bench_rebuild(num_updates=200000, num_keys=50000, processes=0):
+    "rebuilds the state db from the journal with 1 and `processes` (default: all) workers"
+    import multiprocessing
+    with tmpdb() as db:
+        sj = statejournal.StateJournal(db)
+        sj.update_many(get_updates(num_updates, num_keys))
+        sj.commit()
+        for p in sorted(set([1, processes or multiprocessing.cpu_count()])):
+            st = time.time()
+            statejournal.rebuild_state_parallel(db, processes=p, verify=False)
+            report('rebuild.%d' % p, num_updates, time.time() - st)
+
+
+def bench_prune(num_updates=200000, keep=10000):
+    "prunes all but the last `keep` updates, journal sizes and validation before and after"
+    updates = get_updates(num_updates)
+    for segment_size in (None, 2**20):
+        with tmpdb() as db:
+            sj = statejournal.StateJournal(db, segment_size=segment_size)
+            sj.update_many(updates)
+            sj.commit()
+            name = 'prune.segmented' if segment_size else 'prune'
+            before = disk_usage(db.dbfile)[1]
+            st = time.time()
+            sj.prune_before(num_updates - keep + 1)
+            report(name, num_updates - keep, time.time() - st)
+            print '%-32s %10d bytes before %10d bytes after' % (name, before,
+                                                              disk_usage(db.dbfile)[1])
+            st = time.time()
+            assert sj.get_reader().validate_state(num_updates) == sj.state_digest
+            report(name + '.validate', keep, time.time() - st)
+
+
+def bench_workload(num_blocks=10000):
+    "alpha solver and up front generation of the chainmock workload"
+    import utils
+    import chainmock
+    for name, f in (('python', utils._get_alpha_python), ('numpy', utils._get_alpha_numpy)):
+        st = time.time()
+        f(0.2, 0.8)
+        report('workload.get_alpha.' + name, 1, time.time() - st)
+    for seed in (None, 0):
+        st = time.time()
+        w = utils.generate_workload(chainmock.config, num_blocks, seed)
+        report('workload.generate.%s' % seed, len(w['storage_reads']), time.time() - st)
+
+
+benchmarks = dict(update_many=bench_update_many,
+                  readers=bench_readers,
+                  ssv=bench_ssv,
+                  validate=bench_validate,
+                  rollback=bench_rollback,
+                  codecs=bench_codecs,
+                  entry_sizes=bench_entry_sizes,
+                  archive=bench_archive,
+                  durability=bench_durability,
+                  pipelined=bench_pipelined,
+                  hashing=bench_hashing,
+                  get_at=bench_get_at,
+                  rebuild=bench_rebuild,
+                  prune=bench_prune,
+                  workload=bench_workload)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] not in benchmarks:
+        print sys.argv[0], '|'.join(sorted(benchmarks)), '[num_updates]'
+        sys.exit(1)
+    args = [int(a) for a in sys.argv[2:]]
+    benchmarks[sys.argv[1]](*args)
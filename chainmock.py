@@ -1,9 +1,10 @@
-from utils import get_pareto
+from utils import get_pareto, generate_workload
 from ethereum.utils import sha3, big_endian_to_int, int_to_big_endian
 from ethereum.slogging import configure
 from db import LevelDB
 from ethereum.trie import Trie
 import statejournal
+import os
 import sys
 import rlp
 import resource
@@ -15,7 +16,8 @@ config = dict(txs_per_block=get_pareto(806., 156, 317), # 20 / 80
               storage_reads=get_pareto(806., 100, 2327),  # 40 / 60
               storage_read_update_ratio=2,
               storage_read_delete_ratio=2,
-              num_blocks=10000
+              num_blocks=10000,
+              instrumented=bool(os.environ.get('STATEJOURNAL_STATS'))  # see report
               )
 
 
@@ -76,7 +78,7 @@ class Account(object):
     def __init__(self, chain, account):
         self.number = account
         self.address = sha3(str(account))
-        self.storage_slots = int(1 + config['contract_storage_slots'](account))
+        self.storage_slots = 1 + chain.workload_at('storage_slots', account)
         self.chain = chain
 
     def __repr__(self):
@@ -127,16 +129,7 @@ class Account(object):
         self.chain.storage.delete(self.address+str(k))
 
     def keys(self):
-        self.chain.storage.commit()
-        leveldb = self.chain.db.db.db
-        keys =[]
-        for key in leveldb.RangeIter(key_from=self.address, include_value=False):
-            keys.append(key)
-            if key.startswith(self.address):
-                keys.append(key)
-            else:
-                break
-        return keys
+        return [key for key, value in self.chain.storage.db.iter_prefix(self.address)]
 
 class Transaction(object):
 
@@ -151,7 +144,7 @@ class Transaction(object):
         # receiving account
         account = Account(chain, receiver)
 
-        reads = int(config['storage_reads'](tx_num))
+        reads = chain.workload_at('storage_reads', tx_num)
         reads = min(reads, account.storage_slots)
         updates = int(reads / config['storage_read_update_ratio'])
         deletes = int(updates / config['storage_read_delete_ratio'])
@@ -178,7 +171,7 @@ class Transaction(object):
 class Block(object):
     def __init__(self, chain, number):
         self.number = number
-        self.num_txs = int(config['txs_per_block'](number))
+        self.num_txs = chain.workload_at('txs_per_block', number)
         #  print 'num_txs', self.num_txs
         for i in range(self.num_txs):
             account = chain.num_txs % config['num_accounts']
@@ -186,15 +179,30 @@ class Block(object):
             chain.num_txs += 1
 
 
+# workload > config function (see utils.generate_workload)
+workload_functions = dict(txs_per_block='txs_per_block',
+                          storage_slots='contract_storage_slots',
+                          storage_reads='storage_reads')
+
+
 class Chain(object):
 
     num_blocks = 0
     num_txs = 0
     head = None
 
-    def __init__(self, db, storage_class=Storage):
+    def __init__(self, db, storage_class=Storage, workload=None):
+        "workload: see utils.generate_workload (default: for config['num_blocks'])"
         self.db = db
         self.storage = storage_class(db)
+        self.workload = workload or generate_workload(config)
+
+    def workload_at(self, name, i):
+        "returns the workload value, beyond the generated workload that of the config function"
+        values = self.workload[name]
+        if i < len(values):
+            return int(values[i])
+        return int(config[workload_functions[name]](i))
 
     def add_block(self):
         b = Block(self, number=self.num_blocks)
@@ -203,15 +211,15 @@ class Chain(object):
         self.storage.commit()
 
 
-def get_trie_chain(path):
-    db = LevelDB(path)
+def get_trie_chain(path, workload=None, **db_args):
+    db = LevelDB(path, instrumented=config['instrumented'], **db_args)
     t = Trie(db)
-    return Chain(t)
+    return Chain(t, workload=workload)
 
-def get_statejournal_chain(path):
-    db = LevelDB(path)
-    t = statejournal.StateJournal(db)
-    return Chain(t, storage_class=JournalStorage)
+def get_statejournal_chain(path, workload=None, **db_args):
+    db = LevelDB(path, instrumented=config['instrumented'], **db_args)
+    t = statejournal.StateJournal(db, instrumented=config['instrumented'])
+    return Chain(t, storage_class=JournalStorage, workload=workload)
 
 def test_add_blocks(chain, num_blocks):
     for i in range(num_blocks):
@@ -391,6 +399,8 @@ def report(chain):
     print len(chain.storage.seen_keys), 'storage locations'
     print ldb.read_counter, 'db reads'
     print ldb.write_counter, 'db writes'
+    print ldb.cache.hits, 'db cache hits'
+    print ldb.cache.misses, 'db cache misses'
     if chain.num_blocks:
         print s.num_reads, 'app reads'
         print s.num_writes, 'app writes'
@@ -398,10 +408,24 @@ def report(chain):
         print s.num_misses, 'app misses'
         print chain.num_txs, 'transactions'
         print chain.num_blocks, 'blocks'
-
-def test_fake_chain():
-    num_blocks = config['num_blocks']
-    # chain = test_add_blocks(chain, config['num_blocks'])
+    # StateJournal (incl. db and reader) or LevelDB stats
+    print_stats(s.db.stats() if hasattr(s.db, 'stats') else ldb.stats())
+
+
+def print_stats(stats, prefix=''):
+    for name, v in sorted(stats.items()):
+        if isinstance(v, dict):
+            print_stats(v, prefix + name + '.')
+        elif isinstance(v, list):  # histogram
+            print prefix + name, ' '.join('<=%dus:%d' % b for b in v)
+        elif isinstance(v, float):
+            print prefix + name, '%.6f' % v
+        else:
+            print prefix + name, v
+
+def test_fake_chain(chain):
+    "produces config['num_blocks'] blocks (see run_tests.py blocks for the latencies)"
+    return test_add_blocks(chain, config['num_blocks'])
 
 
 if __name__ == '__main__':
@@ -1,21 +1,225 @@
 import os
 import leveldb
 from ethereum import slogging
-from ethereum.compress import compress, decompress
+from ethereum import compress as ethereum_compress
 import time
+import zlib
+from collections import OrderedDict
 
-compress = decompress = lambda x: x
 
-class LevelDB(object):
+def _identity(x):
+    return x
+
+
+# codecs: name > (encode, decode)
+#   none: stores the data as is
+#   zlib: generic compression
+#   ethereum: compresses runs of zero bytes and well known hashes (ethereum.compress)
+# note: key codecs must preserve the key order for range iterations, i.e. only 'none'
+codecs = dict(none=(_identity, _identity),
+              zlib=(zlib.compress, zlib.decompress),
+              ethereum=(ethereum_compress.compress, ethereum_compress.decompress))
+
+
+def prefix_end(prefix):
+    "returns the first key after all keys starting with prefix (None if there is none)"
+    prefix = prefix.rstrip('\xff')
+    if not prefix:
+        return None
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+def merge_sorted(items, overlay):
+    """
+    merges the sorted (key, value) iterables items and overlay,
+    overlay values replace item values, None values (deletes) are skipped
+    """
+    items = iter(items)
+    overlay = iter(overlay)
+    item = next(items, None)
+    over = next(overlay, None)
+    while item or over:
+        if over is None or (item and item[0] < over[0]):
+            yield item
+            item = next(items, None)
+            continue
+        if item and item[0] == over[0]:
+            item = next(items, None)
+        if over[1] is not None:
+            yield over
+        over = next(overlay, None)
+
+
+class ReadCache(object):
+    """
+    bounded cache of committed values
+
+    eviction:
+        'lru': evicts the least recently used key
+        'fifo': evicts the least recently added key
+    """
+
+    evictions = ('lru', 'fifo')
+
+    def __init__(self, size, eviction='lru'):
+        assert eviction in self.evictions, eviction
+        self.size = size
+        self.lru = eviction == 'lru'
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        "returns the value or None"
+        try:
+            if self.lru:
+                v = self.data[key] = self.data.pop(key)
+            else:
+                v = self.data[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return v
+
+    def put(self, key, value):
+        if not self.size:
+            return
+        self.data[key] = value
+        if len(self.data) > self.size:
+            self.data.popitem(last=False)
+
+    def pop(self, key):
+        self.data.pop(key, None)
+
+    def __len__(self):
+        return len(self.data)
+
 
+class GroupCommit(object):
+    """
+    decides when a group of commits is due to be synced,
+    i.e. after `num_commits` commits or `interval_ms` milliseconds since the last sync
+    note: the interval is only checked on commits
+    """
 
-    def __init__(self, dbfile):
+    def __init__(self, interval_ms=None, num_commits=None):
+        assert interval_ms or num_commits
+        self.interval_ms = interval_ms
+        self.num_commits = num_commits
+        self.pending = 0
+        self.last_sync = time.time()
+
+    def due(self):
+        "registers a commit, returns True if the group is due"
+        self.pending += 1
+        if (self.num_commits and self.pending >= self.num_commits) or \
+                (self.interval_ms and (time.time() - self.last_sync) * 1000 >= self.interval_ms):
+            self.synced()
+            return True
+        return False
+
+    def synced(self):
+        self.pending = 0
+        self.last_sync = time.time()
+
+
+durability_modes = ('none', 'flush', 'fsync', 'group')
+
+
+class Stats(object):
+    """
+    opt-in instrumentation (see `instrument`)
+    timers: phase > [calls, seconds]
+    counters: name > count (e.g. bytes)
+    histograms: name > {upper bound in us (power of 2): count}
+    """
+
+    def __init__(self):
+        self.timers = dict()
+        self.counters = dict()
+        self.histograms = dict()
+
+    def add(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def add_time(self, phase, seconds, histogram=False):
+        t = self.timers.setdefault(phase, [0, 0.])
+        t[0] += 1
+        t[1] += seconds
+        if histogram:
+            us = int(seconds * 1e6) + 1
+            bound = 1 << (us - 1).bit_length()
+            h = self.histograms.setdefault(phase, dict())
+            h[bound] = h.get(bound, 0) + 1
+
+    def snapshot(self):
+        return dict(timers=dict((phase, dict(calls=c, seconds=t, mean_us=t / c * 1e6))
+                                for phase, (c, t) in self.timers.items()),
+                    counters=dict(self.counters),
+                    histograms=dict((name, sorted(h.items()))
+                                    for name, h in self.histograms.items()))
+
+
+def instrument(obj, stats, phases):
+    """
+    replaces the methods (or function attributes) of obj with timed ones,
+    i.e. uninstrumented objects run the plain methods.
+    phases: [(attribute, phase, histogram, count)], count(result, *args) returns the counters
+        to add as {name: n} (or None)
+    """
+    for attr, phase, histogram, count in phases:
+        setattr(obj, attr, _timed(getattr(obj, attr), stats, phase, histogram, count))
+
+
+def _timed(f, stats, phase, histogram, count):
+    def timed(*args, **kargs):
+        st = time.time()
+        r = f(*args, **kargs)
+        stats.add_time(phase, time.time() - st, histogram)
+        if count:
+            for name, n in (count(r, *args) or {}).items():
+                stats.add(name, n)
+        return r
+    return timed
+
+
+class LevelDB(object):
+    """
+    uncommitted: the dirty writes (key > value or None if deleted), written on commit
+    cache: a bounded ReadCache for committed values
+    value_codec, key_codec: see `codecs`, must not change for an existing db
+    durability:
+        'none', 'flush': writes are not synced
+        'fsync': every commit is synced
+        'group': a commit is synced every `group_commit_ms` or `group_commit_blocks` commits,
+                 which also syncs the previous commits
+    instrumented: time reads, writes and commits (see `stats`)
+    """
+
+    def __init__(self, dbfile, cache_size=100000, cache_eviction='lru',
+                 value_codec='none', key_codec='none', durability='flush',
+                 group_commit_ms=None, group_commit_blocks=None, instrumented=False):
+        assert durability in durability_modes, durability
+        self.durability = durability
+        if durability == 'group':
+            self.group_commit = GroupCommit(group_commit_ms, group_commit_blocks)
+        self.compress, self.decompress = codecs[value_codec]
+        self.encode_key, self.decode_key = codecs[key_codec]
         self.uncommitted = dict()
+        self.cache = ReadCache(cache_size, cache_eviction)
         self.dbfile = dbfile
         self.db = leveldb.LevelDB(dbfile)
         self.commit_counter = 0
         self.read_counter = 0
         self.write_counter = 0
+        self._stats = None
+        if instrumented:
+            self._stats = Stats()
+            put_bytes = lambda r, key, value: {'bytes.put': len(key) + len(value)}
+            instrument(self, self._stats, [('get', 'get', False, None),
+                                           ('put', 'put', False, put_bytes),
+                                           ('commit', 'commit', True, None)])
 
     def reopen(self):
         # del self.db
@@ -28,23 +232,30 @@ class LevelDB(object):
             if self.uncommitted[key] is None:
                 raise KeyError("key not in db")
             return self.uncommitted[key]
-        o = decompress(self.db.Get(key))
-        self.uncommitted[key] = o
+        o = self.cache.get(key)
+        if o is None:
+            o = self.decompress(self.db.Get(self.encode_key(key)))
+            self.cache.put(key, o)
         return o
 
     def put(self, key, value):
         self.write_counter += 1
         self.uncommitted[key] = value
+        self.cache.pop(key)
 
 
-    def commit(self):
+    def commit(self, sync=None):
+        "sync: overrides the durability mode"
+        if sync is None:
+            sync = self.durability == 'fsync' or \
+                (self.durability == 'group' and self.group_commit.due())
         batch = leveldb.WriteBatch()
         for k, v in self.uncommitted.items():
             if v is None:
-                batch.Delete(k)
+                batch.Delete(self.encode_key(k))
             else:
-                batch.Put(k, compress(v))
-        self.db.Write(batch, sync=False)
+                batch.Put(self.encode_key(k), self.compress(v))
+        self.db.Write(batch, sync=sync)
         self.uncommitted.clear()
         self.commit_counter += 1
         if self.commit_counter % 100 == 0:
@@ -52,6 +263,35 @@ class LevelDB(object):
 
     def delete(self, key):
         self.uncommitted[key] = None
+        self.cache.pop(key)
+
+    def stats(self):
+        "returns the counters, cache hit rate and (if instrumented) the timers"
+        lookups = self.cache.hits + self.cache.misses
+        r = dict(reads=self.read_counter, writes=self.write_counter,
+                 commits=self.commit_counter, cache_hits=self.cache.hits,
+                 cache_misses=self.cache.misses,
+                 cache_hit_rate=self.cache.hits / float(lookups) if lookups else 0.)
+        if self._stats:
+            r.update(self._stats.snapshot())
+        return r
+
+    def range_iter(self, key_from='', key_to=None):
+        """
+        yields the sorted (key, value) for key_from <= key < key_to (or all keys >= key_from),
+        including the uncommitted writes
+        """
+        assert self.encode_key is _identity, 'key codec does not preserve the key order'
+        in_range = lambda k: k >= key_from and (key_to is None or k < key_to)
+        overlay = sorted((k, v) for k, v in self.uncommitted.items() if in_range(k))
+        return merge_sorted(self._range_iter(key_from, key_to), overlay)
+
+    def _range_iter(self, key_from, key_to):
+        for key, value in self.db.RangeIter(key_from=key_from):
+            if key_to is not None and key >= key_to:
+                break
+            self.read_counter += 1
+            yield key, self.decompress(value)
 
     def _has_key(self, key):
         try:
@@ -67,4 +307,5 @@ class LevelDB(object):
         return isinstance(other, self.__class__) and self.db == other.db
 
     def __repr__(self):
-        return '<DB at %d uncommitted=%d>' % (id(self.db), len(self.uncommitted))
+        return '<DB at %d uncommitted=%d cached=%d>' % (id(self.db), len(self.uncommitted),
+                                                        len(self.cache))
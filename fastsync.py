@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+"""
+fast sync: rebuilds the state db and journal of a node from an exported journal,
+without going through the vm
+
+usage:
+    python fastsync.py export <path> [file]  # default: stdout
+    python fastsync.py import <path> [file]  # default: stdin, path must be a fresh db
+
+Stream format:
+    statejournal <digest_mode>\\n
+    followed by the journal entries state_digest[32] | rlp[key, value, old_counter] | trailer
+    (see StateJournal)
+"""
+import sys
+import time
+from ethereum.utils import big_endian_to_int
+from db import LevelDB
+from statejournal import StateJournal, MmapJournalReader, entry_trailer
+
+header_format = 'statejournal %s\n'
+
+
+def export_journal(db, out, update_counter_end=None):
+    "writes the updates up to update_counter_end (default: last update), returns their number"
+    jr = MmapJournalReader(db)
+    assert not jr.base_update_counter, 'can not export a pruned journal'
+    if update_counter_end is None:
+        update_counter_end = jr.update_counter()
+    out.write(header_format % jr.digest_mode)
+    for uc in xrange(1, update_counter_end + 1):
+        state_digest, log = jr.read_raw(uc)
+        out.write(state_digest)
+        out.write(log)
+        out.write(entry_trailer(log))
+    return update_counter_end
+
+
+def read_header(stream):
+    "returns the digest_mode"
+    line = stream.readline()
+    name, digest_mode = line.split()
+    assert line == header_format % digest_mode, 'not an exported journal'
+    return digest_mode
+
+
+def read_entries(stream):
+    "yields the (state_digest, log) of the journal entries in stream"
+    read = stream.read
+    while True:
+        head = read(33)  # state_digest and the first byte of the rlp list
+        if not head:
+            return
+        if len(head) != 33:
+            raise IOError('truncated entry')
+        b0 = ord(head[32])
+        if b0 < 0xc0:
+            raise IOError('invalid entry')
+        if b0 > 0xf7:  # long list
+            length_data = read(b0 - 0xf7)
+            length = big_endian_to_int(length_data)
+        else:
+            length_data = ''
+            length = b0 - 0xc0
+        payload = read(length)
+        log = head[32] + length_data + payload
+        trailer = entry_trailer(log)
+        if len(payload) != length or read(len(trailer)) != trailer:
+            raise IOError('truncated entry')
+        yield head[:32], log
+
+
+def import_journal(db, stream, batch_size=100000, progress=None, **journal_args):
+    """
+    rebuilds the journal and the state in the fresh db from an exported journal stream,
+    validating the chain of state_digests.
+    the state db is written with one WriteBatch per batch_size updates,
+    which only contains the last value of every key in the batch.
+    progress: called with (num_updates, elapsed) after every batch
+    journal_args: passed to the StateJournal (e.g. segment_size)
+    returns the StateJournal
+    """
+    st = time.time()
+    digest_mode = read_header(stream)
+    sj = StateJournal(db, digest_mode=digest_mode, **journal_args)
+    assert sj.update_counter == 0, 'not a fresh db'
+    values = dict()  # key > (value, update_counter) of the batch
+    for state_digest, log in read_entries(stream):
+        key, value, update_counter = sj.append_log(log)
+        values[key] = value, update_counter
+        if sj.state_digest != state_digest:
+            raise IOError('invalid state_digest at update_counter %d' % sj.update_counter)
+        if sj.update_counter % batch_size == 0:
+            _write_values(sj, values)
+            if progress:
+                progress(sj.update_counter, time.time() - st)
+    _write_values(sj, values)
+    sj.commit(checkpoint=True)
+    sj.sync()
+    return sj
+
+
+def _write_values(sj, values):
+    "writes the values with the journal"
+    sj.store_values(values)
+    values.clear()
+    sj.commit()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) not in (3, 4) or sys.argv[1] not in ('export', 'import'):
+        print sys.argv[0], 'export|import <path> [file]'
+        sys.exit(1)
+    task, path = sys.argv[1:3]
+    fn = sys.argv[3] if len(sys.argv) == 4 else '-'
+    st = time.time()
+    if task == 'export':
+        out = sys.stdout if fn == '-' else open(fn, 'wb')
+        num_updates = export_journal(path, out)
+        out.flush()
+        print >> sys.stderr, 'exported', num_updates, 'updates'
+    else:
+        def progress(num_updates, elapsed):
+            print >> sys.stderr, '%12d updates %12.0f updates/sec' % (num_updates,
+                                                                       num_updates / elapsed)
+        stream = sys.stdin if fn == '-' else open(fn, 'rb')
+        sj = import_journal(LevelDB(path), stream, progress=progress)
+        num_updates = sj.update_counter
+        print >> sys.stderr, 'uc/state', num_updates, sj.state_digest.encode('hex')
+    elapsed = time.time() - st
+    print >> sys.stderr, '%.3fs %12.0f updates/sec' % (elapsed, num_updates / max(elapsed, 1e-9))
@@ -0,0 +1,52 @@
+"""
+keccak256 backends for the StateJournal
+
+`sha3` is the fastest available backend, selected at import
+(or set with the STATEJOURNAL_HASH environment variable).
+all backends return the same digests as ethereum.utils.sha3
+and accept strings and buffers.
+"""
+import os
+
+
+def _pysha3():
+    import sha3 as _sha3
+    keccak_256 = _sha3.keccak_256
+    return lambda data: keccak_256(data).digest()
+
+
+def _pycryptodome():
+    from Crypto.Hash import keccak
+    new = keccak.new
+    return lambda data: new(digest_bits=256, data=str(data)).digest()
+
+
+def _ethereum():
+    from ethereum.utils import sha3
+    return sha3
+
+
+backend_loaders = (('pysha3', _pysha3),  # fastest first
+                   ('pycryptodome', _pycryptodome),
+                   ('ethereum', _ethereum))
+
+backends = dict()
+for _name, _loader in backend_loaders:
+    try:
+        backends[_name] = _loader()
+    except ImportError:
+        pass
+
+backend = os.environ.get('STATEJOURNAL_HASH') or \
+    [name for name, _ in backend_loaders if name in backends][0]
+assert backend in backends, 'hash backend %s is not available' % backend
+sha3 = backends[backend]
+
+
+def sha3_many(items):
+    """
+    returns the hashes of items (e.g. the logs of a range of updates).
+    note: a thread pool does not help here, as the backends only release the GIL
+    for inputs of 2KB and more, while logs are mostly < 200 bytes
+    """
+    return map(sha3, items)
@@ -1,62 +1,274 @@
 #!/usr/bin/env python
+"""
+in process benchmark suite of the chainmock tasks for the trie and the journal
+
+usage:
+    python run_tests.py run [num_values] [num_accounts] [out.json]
+    python run_tests.py blocks [num_blocks] [out.json]
+    python run_tests.py compare <base.json> <new.json> [threshold]
+
+run: executes create, read, update, ssv (journal only) and delete
+    on a fresh db per storage and writes the results as JSON (default: stdout).
+    per task: ops/sec, p50/p99 latency per op, db counters, process io
+    and on disk sizes per file, plus the journal speedups over the trie
+blocks: produces num_blocks (default: chainmock.config['num_blocks']) blocks
+    of the chainmock workload per storage and reports block latency (incl. a histogram),
+    the latency of the block commits and the journal growth per block
+compare: lists the tasks which got slower or bigger by more than threshold (default: 0.1),
+    exits with 1 if there are any
+"""
 import os
-import subprocess
-
-# storage = 'journal'
-# for num_values in (10000, 100000, 1000000):
-#     for num_accounts in (num_values, num_values/10, 1):
-#         path = 'data_%s_%d_%d' % (storage, num_values, num_accounts)
-#         for action in ('create', 'read', 'update', 'delete'):
-#             cmd = ['time', 'python', 'chainmock.py', action, storage,
-#                     str(num_values), str(num_accounts), path]
-#             assert 0 == subprocess.call(cmd)
-#             subprocess.call(['du', '-h', path])
-#             subprocess.call(['du', '-h', os.path.join(path, 'state_journal')])
-#             subprocess.call(['du', '-h', os.path.join(path, 'state_journal.idx')])
-#             print '-' *20
-#         print '- -' *20
-#     print '===' *20
-
-
-
-# storage = 'trie'
-# for num_values in (10000, 100000, 1000000):
-#     for num_accounts in (num_values,):
-#         path = 'data_%s_%d_%d' % (storage, num_values, num_accounts)
-#         for action in ('create', 'read', 'update', 'delete'):
-#             cmd = ['time', 'python', 'chainmock.py', action, storage,
-#                     str(num_values), str(num_accounts), path]
-#             assert 0 == subprocess.call(cmd)
-#             subprocess.call(['du', '-h', path])
-#             print '-' *20
-#         print '- -' *20
-#     print '===' *20
-
-
-
-# storage = 'journal'
-# num_values = 100000
-# num_accounts = num_values
-# path = 'data_%s_%d_%d' % (storage, num_values, num_accounts)
-# for action in ['create'] + ['update'] * 100:
-#     cmd = ['time', 'python', 'chainmock.py', action, storage,
-#             str(num_values), str(num_accounts), path]
-#     assert 0 == subprocess.call(cmd)
-#     subprocess.call(['du', '-h', path])
-#     subprocess.call(['du', '-h', os.path.join(path, 'state_journal')])
-#     subprocess.call(['du', '-h', os.path.join(path, 'state_journal.idx')])
-#     print '-' * 20
-
-
-storage = 'trie'
-for num_values in (100000,):
-    for num_accounts in (num_values,):
-        path = 'data_%s_%d_%d' % (storage, num_values, num_accounts)
-        for action in ('create', 'delete'):
-            cmd = ['time', 'python', 'chainmock.py', action, storage,
-                    str(num_values), str(num_accounts), path]
-            assert 0 == subprocess.call(cmd)
-            subprocess.call(['du', '-h', path])
-            print '-' *20
-        print '- -' *20
-    print '===' *20
+import sys
+import time
+import json
+import shutil
+import tempfile
+from ethereum.utils import sha3
+import chainmock
+from utils import generate_workload
+import statejournal
+
+storages = ('trie', 'journal')
+tasks = ('create', 'read', 'update', 'ssv', 'delete')  # ssv needs the created keys
+task_functions = dict(create=chainmock.test_writes,
+                      read=chainmock.test_reads,
+                      update=chainmock.test_update,
+                      ssv=chainmock.test_ssv,
+                      delete=chainmock.test_delete)
+timed_methods = ('get', 'update', 'delete')  # of the chainmock.Storage
+
+
+def percentile(values, p):
+    "returns the p-th percentile of the sorted values"
+    if not values:
+        return 0.
+    return values[min(len(values) - 1, int(len(values) * p / 100.))]
+
+
+def histogram(values):
+    "returns [upper_bound_us, count] of the sorted latencies in power of 2 buckets"
+    buckets = []
+    bound = 1
+    for v in values:
+        while v * 1e6 > bound:
+            bound *= 2
+        if buckets and buckets[-1][0] == bound:
+            buckets[-1][1] += 1
+        else:
+            buckets.append([bound, 1])
+    return buckets
+
+
+def read_io():
+    "returns the io counters of this process (linux only, otherwise {})"
+    if not os.path.exists('/proc/self/io'):
+        return dict()
+    lines = [l.split(':') for l in open('/proc/self/io')]
+    return dict((k, int(v)) for k, v in lines if k in ('rchar', 'wchar', 'read_bytes',
+                                                        'write_bytes'))
+
+
+def read_counters(ldb):
+    "returns the (reads, writes, commits, cache_hits, cache_misses) of the LevelDB"
+    return [ldb.read_counter, ldb.write_counter, ldb.commit_counter,
+            ldb.cache.hits, ldb.cache.misses]
+
+
+def disk_sizes(path):
+    "returns the on disk sizes of the journal files and of all leveldb files"
+    sizes = dict(leveldb=0)
+    for fn in os.listdir(path):
+        size = os.path.getsize(os.path.join(path, fn))
+        if fn.startswith(statejournal.StateJournal.state_journal_fn):
+            sizes[fn] = size
+        else:
+            sizes['leveldb'] += size
+    return sizes
+
+
+def timed(storage, latencies):
+    "records the latency of every call of the timed_methods of storage in latencies"
+    def wrap(f):
+        def _f(*args):
+            st = time.time()
+            r = f(*args)
+            latencies.append(time.time() - st)
+            return r
+        return _f
+    for name in timed_methods:
+        setattr(storage, name, wrap(getattr(storage, name)))
+
+
+def untimed(storage):
+    for name in timed_methods:
+        delattr(storage, name)
+
+
+def run_task(chain, task, accounts, num_values):
+    "returns the results of task"
+    ldb = chain.storage.db.db
+    counters = read_counters(ldb)
+    io = read_io()
+    latencies = []
+    timed(chain.storage, latencies)
+    st = time.time()
+    task_functions[task](chain, accounts, num_values)
+    chain.storage.commit()
+    elapsed = time.time() - st
+    untimed(chain.storage)
+    latencies = sorted(latencies) or [elapsed]
+    counters = [b - a for a, b in zip(counters, read_counters(ldb))]
+    return dict(ops=len(latencies),
+                elapsed=elapsed,
+                ops_per_sec=len(latencies) / elapsed,
+                p50_us=percentile(latencies, 50) * 1e6,
+                p99_us=percentile(latencies, 99) * 1e6,
+                db=dict(zip(('reads', 'writes', 'commits', 'cache_hits', 'cache_misses'),
+                            counters)),
+                io=dict((k, v - io[k]) for k, v in read_io().items()),
+                disk=disk_sizes(ldb.dbfile))
+
+
+def run(num_values=100000, num_accounts=None):
+    "returns the results of all tasks for all storages"
+    num_accounts = num_accounts or num_values
+    accounts = [sha3(str(i)) for i in range(num_accounts)]
+    results = dict()
+    for storage in storages:
+        path = tempfile.mkdtemp(prefix='sj_run_')
+        try:
+            if storage == 'trie':
+                chain = chainmock.get_trie_chain(path)
+            else:
+                chain = chainmock.get_statejournal_chain(path)
+            results[storage] = dict()
+            for task in tasks:
+                if task == 'ssv' and storage != 'journal':
+                    continue
+                results[storage][task] = run_task(chain, task, accounts, num_values)
+            del chain
+        finally:
+            shutil.rmtree(path)
+    speedup = dict((task, r['ops_per_sec'] / results['trie'][task]['ops_per_sec'])
+                   for task, r in results['journal'].items() if task in results['trie'])
+    return dict(config=dict(num_values=num_values, num_accounts=num_accounts),
+                results=results,
+                speedup=speedup)
+
+
+def produce_blocks(path, storage, workload, num_blocks):
+    "returns the results of producing num_blocks blocks, the db is closed on return"
+    if storage == 'trie':
+        chain = chainmock.get_trie_chain(path, workload)
+    else:
+        chain = chainmock.get_statejournal_chain(path, workload)
+    sj = chain.storage.db if storage == 'journal' else None
+    commit, commits = chain.storage.commit, []
+
+    def timed_commit():
+        st = time.time()
+        commit()
+        commits.append(time.time() - st)
+    chain.storage.commit = timed_commit
+    latencies, block_commits, growth = [], [], []
+    st = time.time()
+    for i in range(num_blocks):
+        journal_pos = sj.journal_pos if sj else 0
+        bst = time.time()
+        chain.add_block()
+        latencies.append(time.time() - bst)
+        block_commits.append(commits[-1])  # deletes commit too
+        if sj:
+            growth.append(sj.journal_pos - journal_pos)
+    elapsed = time.time() - st
+    del chain.storage.commit  # reference cycle, which would keep the db open
+    latencies.sort()
+    block_commits.sort()
+    growth.sort()
+    return dict(ops=num_blocks,
+                txs=chain.num_txs,
+                elapsed=elapsed,
+                ops_per_sec=num_blocks / elapsed,
+                p50_us=percentile(latencies, 50) * 1e6,
+                p90_us=percentile(latencies, 90) * 1e6,
+                p99_us=percentile(latencies, 99) * 1e6,
+                max_us=latencies[-1] * 1e6,
+                histogram=histogram(latencies),
+                commit_p50_us=percentile(block_commits, 50) * 1e6,
+                commit_p99_us=percentile(block_commits, 99) * 1e6,
+                commit_histogram=histogram(block_commits),
+                journal_growth=dict(p50=percentile(growth, 50), p99=percentile(growth, 99),
+                                    max=growth[-1] if growth else 0, total=sum(growth)),
+                disk=disk_sizes(path))
+
+
+def run_blocks(num_blocks=None, seed=None):
+    """
+    returns the results of producing num_blocks blocks for all storages
+    seed: see utils.generate_workload, the workload is generated before the blocks
+    """
+    num_blocks = num_blocks or chainmock.config['num_blocks']
+    workload = generate_workload(chainmock.config, num_blocks, seed)
+    results = dict()
+    for storage in storages:
+        path = tempfile.mkdtemp(prefix='sj_run_')
+        try:
+            results[storage] = dict(blocks=produce_blocks(path, storage, workload, num_blocks))
+        finally:
+            shutil.rmtree(path)
+    return dict(config=dict(num_blocks=num_blocks, seed=seed), results=results)
+
+
+def compare(base, new, threshold=0.1):
+    "returns the regressions of new against base as (storage, task, metric, base, new)"
+    regressions = []
+    for storage, task_results in new['results'].items():
+        for task, r in task_results.items():
+            b = base['results'].get(storage, {}).get(task)
+            if not b:
+                continue
+            if r['ops_per_sec'] < b['ops_per_sec'] * (1 - threshold):
+                regressions.append((storage, task, 'ops_per_sec', b['ops_per_sec'],
+                                    r['ops_per_sec']))
+            for metric in ('p50_us', 'p99_us'):
+                if r[metric] > b[metric] * (1 + threshold):
+                    regressions.append((storage, task, metric, b[metric], r[metric]))
+            size, base_size = sum(r['disk'].values()), sum(b['disk'].values())
+            if size > base_size * (1 + threshold):
+                regressions.append((storage, task, 'disk', base_size, size))
+    return sorted(regressions)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] not in ('run', 'blocks', 'compare'):
+        print sys.argv[0], 'run [num_values] [num_accounts] [out.json]'
+        print sys.argv[0], 'blocks [num_blocks] [out.json]'
+        print sys.argv[0], 'compare <base.json> <new.json> [threshold]'
+        sys.exit(1)
+    if sys.argv[1] == 'run':
+        args = [int(a) for a in sys.argv[2:4]]
+        out = open(sys.argv[4], 'w') if len(sys.argv) > 4 else sys.stdout
+        sys.stdout = sys.stderr  # keeps the JSON clean of the chainmock output
+        r = run(*args)
+        json.dump(r, out, indent=2, sort_keys=True)
+        print >> out
+        for task, speedup in sorted(r['speedup'].items()):
+            print >> sys.stderr, '%-8s x%.1f faster than the trie' % (task, speedup)
+    elif sys.argv[1] == 'blocks':
+        num_blocks = int(sys.argv[2]) if len(sys.argv) > 2 else None
+        out = open(sys.argv[3], 'w') if len(sys.argv) > 3 else sys.stdout
+        sys.stdout = sys.stderr
+        r = run_blocks(num_blocks)
+        json.dump(r, out, indent=2, sort_keys=True)
+        print >> out
+        for storage, b in sorted(r['results'].items()):
+            b = b['blocks']
+            print >> sys.stderr, '%-8s %8.1f blocks/sec p50 %8.0fus p99 %8.0fus max %8.0fus' % (
+                storage, b['ops_per_sec'], b['p50_us'], b['p99_us'], b['max_us'])
+    else:
+        base, new = [json.load(open(fn)) for fn in sys.argv[2:4]]
+        threshold = float(sys.argv[4]) if len(sys.argv) > 4 else 0.1
+        regressions = compare(base, new, threshold)
+        for storage, task, metric, b, n in regressions:
+            print '%-8s %-8s %-12s %14.1f > %14.1f' % (storage, task, metric, b, n)
+        sys.exit(1 if regressions else 0)
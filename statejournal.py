@@ -1,7 +1,22 @@
-from ethereum.utils import sha3
+from hashing import sha3, sha3_many
 from ethereum.utils import big_endian_to_int, int_to_big_endian, zpad
+from proofofexistence.notary import distant_ancestor, get_path
+from db import LevelDB, GroupCommit, durability_modes, prefix_end, merge_sorted
+from db import Stats, instrument
 import rlp
 import os
+import sys
+import Queue
+import mmap
+import struct
+import random
+import time
+import zlib
+import bisect
+import shutil
+import threading
+import multiprocessing
+from collections import OrderedDict
 
 """
 Efficient journal based cryptographically authenticated data structure
@@ -113,12 +128,226 @@ DHT based StateJournal:
 """
 b32 = 2**32
 b16 = 2**16
+# log_size of entries >= b16 bytes, which are followed by a log_size[8]
+# (normal entries are at least 38 bytes)
+LARGE_ENTRY = 8
+EOF = 2
+
+
+def H(a, b):
+    "order independent hash of two digests"
+    if a > b:
+        return sha3(a + b)
+    return sha3(b + a)
+
+
+def evaluate_ssv_log(hashes):
+    """
+    evaluates a proof returned by `JournalReader.get_ssv_log`
+    should return: the state_digest (at the time of requesting the proof)
+    """
+    assert len(hashes) >= 3
+    h = H(hashes[0], hashes[1])
+    for x in hashes[2:]:
+        h = H(h, x)
+    return h
+
+
+def read_segment_size(dbfile):
+    "returns the segment size of a segmented journal in dbfile (None if not segmented)"
+    fn = os.path.join(dbfile, StateJournal.state_journal_segments_fn)
+    if os.path.exists(fn):
+        return int(open(fn).read())
+
+
+def segment_fn(dbfile, segment):
+    return os.path.join(dbfile, '%s.%06d' % (StateJournal.state_journal_fn, segment))
+
+
+def segment_exists(dbfile, segment):
+    "True if the segment exists as raw or archived segment"
+    fn = segment_fn(dbfile, segment)
+    return os.path.exists(fn) or os.path.exists(fn + ArchivedSegment.data_ext)
+
+
+def read_digest_mode(dbfile):
+    "returns the digest mode of the journal in dbfile (None if not yet set)"
+    fn = os.path.join(dbfile, StateJournal.state_journal_mode_fn)
+    if os.path.exists(fn):
+        return open(fn).read().strip()
+
+
+def read_anchor(dbfile):
+    """
+    returns the anchor (update_counter, state_digest, journal_pos) of a pruned journal
+    and the retained state_digests {update_counter: state_digest} before it
+    (see `StateJournal.prune_before`)
+    """
+    digests = {0: StateJournal.empty_state_digest}
+    fn = os.path.join(dbfile, StateJournal.state_journal_anchor_fn)
+    if not os.path.exists(fn):
+        return (0, StateJournal.empty_state_digest, 0), digests
+    data = open(fn).read()
+    anchor = struct.unpack_from(StateJournal.anchor_format, data)
+    size = struct.calcsize(StateJournal.anchor_digest_format)
+    for i in range(struct.calcsize(StateJournal.anchor_format), len(data), size):
+        uc, digest = struct.unpack_from(StateJournal.anchor_digest_format, data, i)
+        digests[uc] = digest
+    digests[anchor[0]] = anchor[1]
+    return anchor, digests
+
+
+def pruned_ancestors(update_counter):
+    """
+    returns the update_counters before update_counter, which are
+    distant ancestors of later updates (i.e. needed for skiplist state_digests)
+    """
+    ancestors = set()
+    q = 1
+    while q <= 2 * update_counter + 2:
+        # the distant ancestor of n is n - q, where q (a power of 2) divides n or n + 1
+        for n in (update_counter / q + 1) * q, ((update_counter + 1) / q + 1) * q - 1:
+            if n > update_counter and 0 < distant_ancestor(n) < update_counter:
+                ancestors.add(distant_ancestor(n))
+        q *= 2
+    return sorted(ancestors)
+
+
+def finish_prune(dbfile):
+    """
+    completes an interrupted `StateJournal.prune_before`, i.e. replaces the files with
+    their pruned copies if the new anchor was written and removes pruned segments
+    """
+    fn = os.path.join(dbfile, StateJournal.state_journal_anchor_fn)
+    committed = os.path.exists(fn + '.new')
+    for name in StateJournal.pruned_fns:
+        pfn = os.path.join(dbfile, name)
+        if os.path.exists(pfn + '.pruned'):
+            if committed:
+                os.rename(pfn + '.pruned', pfn)
+            else:
+                os.remove(pfn + '.pruned')
+    if committed:
+        os.rename(fn + '.new', fn)
+    segment_size = read_segment_size(dbfile)
+    if segment_size:
+        journal_pos = read_anchor(dbfile)[0][2]
+        for segment in range(journal_pos / segment_size):
+            for ext in ('', ArchivedSegment.data_ext, ArchivedSegment.index_ext):
+                if os.path.exists(segment_fn(dbfile, segment) + ext):
+                    os.remove(segment_fn(dbfile, segment) + ext)
+
+
+def _copy_from(fn, offset, dst):
+    "copies the file fn from offset to dst"
+    with open(fn, 'rb') as f:
+        with open(dst, 'wb') as out:
+            f.seek(offset)
+            shutil.copyfileobj(f, out, 2**20)
+            out.flush()
+            os.fsync(out.fileno())
+
+
+def history_record(prev_update_counter, read_history):
+    """
+    returns the history record (depth, prev_update_counter, jump_update_counter) of an update,
+    given the previous update of its key and a function returning the records of older updates.
+    jump pointers as in Myers' skew binary random access lists (1983),
+    i.e. finding an older update takes O(log(depth)) steps
+    """
+    depth, _, jump = read_history(prev_update_counter)
+    jump_depth, _, jump_jump = read_history(jump)
+    if depth - jump_depth == jump_depth - read_history(jump_jump)[0]:
+        return depth + 1, prev_update_counter, jump_jump
+    return depth + 1, prev_update_counter, prev_update_counter
+
+
+def entry_trailer(log):
+    "returns the journal_entry_length trailer of the journal entry of log"
+    journal_entry_length = 32 + len(log) + 2
+    if journal_entry_length < b16:
+        return zpad(int_to_big_endian(journal_entry_length), 2)  # 2 bytes
+    journal_entry_length += LARGE_ENTRY
+    return struct.pack('>QH', journal_entry_length, LARGE_ENTRY)  # 10 bytes
+
+
+def parse_entry(data, log_end_pos):
+    "returns buffers of the (state_digest, log) of the entry ending at log_end_pos in data"
+    log_len, = struct.unpack_from('>H', data, log_end_pos - 2)
+    trailer_len = 2
+    if log_len == LARGE_ENTRY:
+        log_len, = struct.unpack_from('>Q', data, log_end_pos - 2 - LARGE_ENTRY)
+        trailer_len += LARGE_ENTRY
+    pos = log_end_pos - log_len
+    return buffer(data, pos, 32), buffer(data, pos + 32, log_len - 32 - trailer_len)
+
+
+class JournalWriter(threading.Thread):
+    """
+    runs the journal file and leveldb writes of a pipelined StateJournal.
+    tasks are (function, args) and are run in order, the queue is bounded,
+    i.e. `put` blocks if the writer falls behind (backpressure).
+    the first error stops the writer and is raised on every `barrier`.
+    `close` stops the thread after the queued tasks.
+    """
+
+    def __init__(self, queue_size):
+        threading.Thread.__init__(self, name='JournalWriter')
+        self.daemon = True
+        self.queue = Queue.Queue(queue_size)
+        self.error = None
+        self.start()
+
+    def run(self):
+        while True:
+            task = self.queue.get()
+            if task is None:  # close
+                self.queue.task_done()
+                return
+            f, args = task
+            try:
+                if not self.error:
+                    f(*args)
+            except Exception:
+                self.error = sys.exc_info()
+            finally:
+                self.queue.task_done()
+
+    def put(self, f, *args):
+        self.queue.put((f, args))
+
+    def barrier(self):
+        "waits until all tasks are done, raises the writer error if there was one"
+        self.queue.join()
+        if self.error:
+            raise self.error[0], self.error[1], self.error[2]
+
+    def close(self):
+        self.queue.put(None)
+        self.join()
 
 
 class StateJournal(object):
     state_journal_fn = 'state_journal'
     state_journal_index_fn = 'state_journal.idx'
+    state_journal_log_hashes_fn = 'state_journal.lh'
+    state_journal_mode_fn = 'state_journal.mode'
+    state_journal_checkpoints_fn = 'state_journal.cp'
+    state_journal_segments_fn = 'state_journal.seg'
+    state_journal_history_fn = 'state_journal.hs'
+    state_journal_anchor_fn = 'state_journal.anchor'
+    # files which lose their prefix when pruning
+    pruned_fns = (state_journal_fn, state_journal_index_fn, state_journal_log_hashes_fn,
+                  state_journal_checkpoints_fn, state_journal_history_fn)
+    checkpoint_format = '>Q32sQ'
+    checkpoint_size = struct.calcsize(checkpoint_format)
+    history_format = '>QQQ'
+    history_size = struct.calcsize(history_format)
+    anchor_format = '>Q32sQ'
+    anchor_digest_format = '>Q32s'
+    digest_modes = ('linear', 'skiplist')
     empty_state_digest = sha3('')
+    pipeline_chunk_size = 1000  # updates handed to the JournalWriter at once
 
     """
     Updates to the state are tracked by state_digest updates
@@ -135,37 +364,286 @@ class StateJournal(object):
     Rollbacks are supported by
         - reading the log backwards and restoring the old values
         - non final states should better be kept in a chain of in memory State Journals
+          (see `fork` and MemoryStateJournal)
 
     Datastructure:
 
         Key Value Store (the state db):
             mapping(key : rlp[value, update_counter])
             note: `key` can be of arbitrary size
+            deleted keys are kept as rlp['', update_counter of the delete],
+            i.e. the old_counter of a re-created key is the delete
 
         Journal Log:
             state_digest[32] | rlp[key, value, old_counter] | log_size[2]
+            entries >= 64KB:
+            state_digest[32] | rlp[key, value, old_counter] | log_size[8] | LARGE_ENTRY[2]
 
         Journal Index:
             journal_pos_ptr[4]
             i.e post log pos position is at (update_counter-1) * 4
+
+        Segmented Journal (if created with a `segment_size`):
+            the journal log is split into files state_journal.000000, state_journal.000001, ...
+            segment N holds the journal positions [N * segment_size, (N+1) * segment_size)
+            and entries do not span segments.
+            journal_pos_ptr[8] in the index
+
+        Log Hashes:
+            H(log)[32]
+            i.e. the hash of the log is at (update_counter-1) * 32
+
+        Checkpoints:
+            update_counter[8] | state_digest[32] | journal_pos_ptr[8]
+            added every `checkpoint_interval` updates and on `commit(checkpoint=True)`
+
+        History (if created with `history`):
+            depth[8] | prev_update_counter[8] | jump_update_counter[8]
+            i.e. the record of an update is at (update_counter-1) * 24
+            depth is the number of updates in the history of the key,
+            jump points to an older update of the key (see `history_record`)
+
+        Anchor (if pruned, see `prune_before`):
+            update_counter[8] | state_digest[32] | journal_pos_ptr[8]
+            followed by update_counter[8] | state_digest[32] of retained distant ancestors
+            update_counters, journal positions and segments do not change when pruning,
+            i.e. the index, log hashes and history start at the anchor update_counter
+            and the (unsegmented) journal at the anchor journal_pos
+
+    Durability Modes:
+        none: commits do not flush the journal files (unless there is a reader)
+        flush: commits flush the journal files and leveldb to the OS
+        fsync: commits fsync the journal, then log hashes, checkpoints and the index,
+               then leveldb, i.e. the index never points past durable journal bytes
+        group: like fsync, but commits are deferred and
+               committed together every `group_commit_ms` or `group_commit_blocks`
+               (and on `sync`)
+
+    Pipelined Mode:
+        the caller computes the logs and state_digests, while a JournalWriter thread
+        writes the journal files and the leveldb batches.
+        `commit` is the barrier, i.e. it waits for the writer and raises its errors.
+
+    Digest Modes:
+        linear:
+            state_digest = H(last_state_digest, H(log))
+            SSVs are O(n)
+        skiplist:
+            state_digest = H(distant_state_digest, H(H(log), last_state_digest))
+            where distant_state_digest is the state_digest at
+            `distant_ancestor(update_counter)` (see proofofexistence.notary)
+            and H is order independent.
+            SSVs are O(log(n))
     """
 
 
-    def __init__(self, db):
-        self.journal = open(os.path.join(db.dbfile, self.state_journal_fn), 'a')
+    def __init__(self, db, write_batch=False, digest_mode=None, checkpoint_interval=10000,
+                 validate=False, segment_size=None, durability='flush', group_commit_ms=None,
+                 group_commit_blocks=None, pipelined=False, pipeline_queue_size=16,
+                 history=False, instrumented=False):
+        """
+        write_batch: if set, journal entries are buffered in memory and
+            written with one write per file on `commit`
+        digest_mode: 'linear' or 'skiplist', is fixed when the journal is created
+        checkpoint_interval: add a checkpoint every N updates (0: only on request)
+        validate: validate the journal from the last checkpoint on startup
+        segment_size: creates a segmented journal with segments of up to segment_size bytes,
+            is fixed when the journal is created. updates with larger journal entries
+            raise ValueError and leave the journal unchanged
+        durability: 'none', 'flush', 'fsync' or 'group' (see Durability Modes)
+        pipelined: write in a background thread (see Pipelined Mode),
+            with up to pipeline_queue_size queued chunks of pipeline_chunk_size updates
+        history: keep skip pointers for the update history of keys (see `get_at`),
+            once added it is kept for the journal
+        instrumented: time the phases of updates and commits, count the written bytes
+            (also for the reader of `get_reader`), see `stats`
+        """
+        assert durability in durability_modes, durability
+        self.durability = durability
+        if durability == 'group':
+            self.group_commit = GroupCommit(group_commit_ms, group_commit_blocks)
+        # unbuffered writes could reach the index before the journal is synced
+        write_batch = write_batch or durability in ('fsync', 'group') or pipelined
+        finish_prune(db.dbfile)
+        anchor = read_anchor(db.dbfile)[0]
+        self.base_update_counter = anchor[0]
         self.journal_index = open(os.path.join(db.dbfile, self.state_journal_index_fn), 'a')
+        self.log_hashes = open(os.path.join(db.dbfile, self.state_journal_log_hashes_fn), 'a')
+        self.checkpoints = open(os.path.join(db.dbfile, self.state_journal_checkpoints_fn), 'a')
+        fn = os.path.join(db.dbfile, self.state_journal_history_fn)
+        self.history = open(fn, 'a') if history or os.path.exists(fn) else None
+        self.checkpoint_interval = checkpoint_interval
+        self.segment_size = self._init_segment_size(db.dbfile, segment_size)
+        if self.segment_size:
+            self.index_entry_size = 8
+            self.segment = anchor[2] / self.segment_size  # earlier segments are pruned
+            while segment_exists(db.dbfile, self.segment + 1):
+                self.segment += 1
+            self.journal = open(segment_fn(db.dbfile, self.segment), 'a')
+        else:
+            self.index_entry_size = 4
+            self.journal = open(os.path.join(db.dbfile, self.state_journal_fn), 'a')
+        self.journal_base = 0 if self.segment_size else anchor[2]  # journal_pos of the file start
+        self.journal.seek(0, EOF)
+        self.journal_pos = self.journal.tell() + self.journal_base
+        if self.segment_size:
+            self.journal_pos += self.segment * self.segment_size
+        self.write_batch = write_batch
+        self._journal_buffer = []
+        self._index_buffer = []
+        self._log_hashes_buffer = []
+        self._checkpoints_buffer = []
+        self._history_buffer = []
+        # in write order, the index is written last
+        self._buffers = (('journal', self._journal_buffer),
+                         ('log_hashes', self._log_hashes_buffer),
+                         ('checkpoints', self._checkpoints_buffer),
+                         ('history', self._history_buffer),
+                         ('journal_index', self._index_buffer))
+        self._reader = None
+        self._writer = None
+        self._encode, self._hash = rlp.encode, sha3  # timed if instrumented
+        self._stats = Stats() if instrumented else None
         self.db = db
-        l = JournalReader(db).last_update()
+        jr = JournalReader(db)
+        l = jr.last_update()
         if l:
             self.state_digest = l['state_digest']
             self.update_counter = l['update_counter']
         else:
             self.state_digest = self.empty_state_digest
             self.update_counter = 0
+        self._sync_log_hashes(jr)
+        self.digest_mode = self._init_digest_mode(digest_mode)
+        self._pending_digests = dict()  # update_counter > state_digest, since last commit
+        self._pending_history = dict()  # update_counter > history record, since last commit
+        self._pending_logs = dict()  # update_counter > log, since last commit
+        self._truncate_checkpoints(jr, self.update_counter)  # interrupted write
+        if self.history:
+            self._sync_history(jr)
+        if self.digest_mode == 'skiplist' or self.history:
+            self.get_reader()
+        if validate:
+            cp_uc, cp_digest, _ = jr.nearest_checkpoint(self.update_counter)
+            assert jr.validate_range(cp_uc + 1, cp_digest, self.update_counter) == \
+                self.state_digest
+        if pipelined:
+            self._writer = JournalWriter(pipeline_queue_size)
+        if instrumented:
+            written = lambda r, chunks, flush, fsync: dict(('bytes.' + name, len(data))
+                                                          for name, data in chunks)
+            instrument(self, self._stats, [('get_raw', 'get_raw', False, None),
+                                           ('_encode', 'rlp', False, None),
+                                           ('_hash', 'sha3', False, None),
+                                           ('_next_state_digest', 'state_digest', False, None),
+                                           ('_write_files', 'write', False, written),
+                                           ('_commit', 'commit', True, None),
+                                           ('sync', 'flush', True, None)])
         print 'uc/state', self.update_counter, self.state_digest.encode('hex')
 
+    def _init_segment_size(self, dbfile, segment_size):
+        persisted = read_segment_size(dbfile)
+        if persisted is None and segment_size:
+            self.journal_index.seek(0, EOF)
+            assert self.journal_index.tell() == 0, 'can not segment an existing journal'
+            with open(os.path.join(dbfile, self.state_journal_segments_fn), 'w') as f:
+                f.write(str(segment_size))
+            persisted = segment_size
+        assert segment_size in (None, persisted), (segment_size, persisted)
+        return persisted
+
+    def _next_segment(self):
+        "continues the journal in a new segment"
+        self.segment += 1
+        self._write(self._open_segment, self._take(self._journal_buffer), self.segment)
+        self.journal_pos = self.segment * self.segment_size
+
+    def _open_segment(self, journal_data, segment):
+        "finishes the current segment with journal_data and opens segment"
+        self.journal.write(journal_data)
+        self.journal.flush()
+        if self.durability in ('fsync', 'group'):
+            os.fsync(self.journal.fileno())
+        self.journal.close()
+        self.journal = open(segment_fn(self.db.dbfile, segment), 'a')
+
+    def _truncate_journal(self, pos):
+        "truncates the journal at journal position pos"
+        self.journal_pos = pos
+        if not self.segment_size:
+            self.journal.truncate(pos - self.journal_base)
+            return
+        segment = max(pos - 1, 0) / self.segment_size
+        self.journal.close()
+        while self.segment > segment:
+            os.remove(segment_fn(self.db.dbfile, self.segment))
+            self.segment -= 1
+        self.journal = open(segment_fn(self.db.dbfile, segment), 'a')
+        self.journal.truncate(pos - segment * self.segment_size)
+
+    def _truncate_checkpoints(self, jr, update_counter):
+        "removes checkpoints after update_counter"
+        num_checkpoints = len([c for c in jr.read_checkpoints() if c[0] <= update_counter])
+        self.checkpoints.truncate(num_checkpoints * self.checkpoint_size)
+
+    def _sync_log_hashes(self, jr):
+        "adds missing log hashes (e.g. for journals created w/o them)"
+        self.log_hashes.seek(0, EOF)
+        num_log_hashes = self.base_update_counter + self.log_hashes.tell() / 32
+        if num_log_hashes > self.update_counter:  # interrupted write
+            self.log_hashes.truncate((self.update_counter - self.base_update_counter) * 32)
+        self.log_hashes.write(''.join(sha3_many(
+            jr.read_raw(uc)[1] for uc in range(num_log_hashes + 1, self.update_counter + 1))))
+        self.log_hashes.flush()
+
+    def _sync_history(self, jr):
+        "adds missing history records (e.g. for journals created w/o them)"
+        self.history.seek(0, EOF)
+        num_records = self.base_update_counter + self.history.tell() / self.history_size
+        if num_records > self.update_counter:  # interrupted write
+            self.history.truncate((self.update_counter - self.base_update_counter) *
+                                  self.history_size)
+        for uc in range(num_records + 1, self.update_counter + 1):
+            prev = big_endian_to_int(rlp.decode(jr.read_raw(uc)[1])[2])
+            self._add_history(uc, prev, jr.read_history)
+            if len(self._history_buffer) >= 10000:
+                self.history.write(self._take(self._history_buffer))
+                self.history.flush()
+                self._pending_history.clear()
+        self.history.write(self._take(self._history_buffer))
+        self.history.flush()
+        self._pending_history.clear()
+
+    def _add_history(self, update_counter, prev_update_counter, read_history):
+        "buffers the history record of an update, read_history reads committed records"
+        def _read_history(uc):
+            if 0 < uc <= self.base_update_counter:  # pruned, i.e. the history starts here
+                return 0, 0, 0
+            return self._pending_history.get(uc) or read_history(uc)
+        record = history_record(prev_update_counter, _read_history)
+        self._pending_history[update_counter] = record
+        self._history_buffer.append(struct.pack(self.history_format, *record))
+
+    def _init_digest_mode(self, digest_mode):
+        persisted = read_digest_mode(self.db.dbfile)
+        if not persisted:
+            # journals created before digest modes are linear
+            persisted = digest_mode if self.update_counter == 0 and digest_mode else 'linear'
+            assert persisted in self.digest_modes, persisted
+            with open(os.path.join(self.db.dbfile, self.state_journal_mode_fn), 'w') as f:
+                f.write(persisted)
+        assert digest_mode in (None, persisted), (digest_mode, persisted)
+        return persisted
+
+    def _digest_at(self, update_counter):
+        if update_counter == 0:
+            return self.empty_state_digest
+        if update_counter in self._pending_digests:
+            return self._pending_digests[update_counter]
+        return self._reader.read_digest(update_counter)
+
     def get_raw(self, key):
-        "returns (value, update_counter)"
+        "returns (value, update_counter), ('', update_counter of the delete) for deleted keys"
         try:
             v = self.db.get(key)
             val, counter = rlp.decode(v)
@@ -178,6 +656,43 @@ class StateJournal(object):
         "returns value"
         return self.get_raw(key)[0]
 
+    def get_at(self, key, update_counter):
+        "returns the value of key after update_counter (see `get_at_many`)"
+        return self.get_at_many([key], update_counter)[0]
+
+    def get_at_many(self, keys, update_counter):
+        """
+        returns the values of keys after update_counter,
+        by following the history of every key backwards from its current update,
+        in O(log(changes)) if the journal keeps a `history`, otherwise O(changes).
+        the history of deleted and re-created keys continues through the delete
+        """
+        assert 0 <= update_counter <= self.update_counter
+        if not self._reader:  # w/o committing the pending updates
+            self._write(self._write_files, [(name, '') for name, _ in self._buffers], True, False)
+            if self._writer:
+                self._writer.barrier()
+            self._reader = MmapJournalReader(self.db, instrumented=bool(self._stats))
+        jr = self._reader
+        # uncommitted updates are read from memory
+        read_history = lambda uc: self._pending_history.get(uc) or jr.read_history(uc)
+        read_log = lambda uc: self._pending_logs.get(uc) or jr.read_raw(uc)[1]
+        values = []
+        for key in keys:
+            value, uc = self.get_raw(key)
+            if uc > update_counter:
+                uc = jr.find_update_at(uc, update_counter, read_history, read_log)
+                value = rlp.decode(read_log(uc))[1] if uc else b''
+            values.append(value)
+        return values
+
+    def iter_prefix(self, prefix):
+        "yields the sorted (key, value) of all keys starting with prefix, incl. uncommitted ones"
+        for key, v in self.db.range_iter(prefix, prefix_end(prefix)):
+            value = rlp.decode(v)[0]
+            if value:  # not deleted
+                yield key, value
+
     def update(self, key, value):
         """
         - increases the update counter
@@ -188,47 +703,220 @@ class StateJournal(object):
         - adds to the journal: state_digest | log | journal_entry_length
         - updates index with the postion of the end of above journal_entry
         """
-        self.update_counter += 1
-        old_value, old_counter = self.get_raw(key)
+        self._update(key, value)
+        if not self.write_batch:
+            self._write_buffers()
 
-        # store in leveldb
-        if value:
-            _stored_value = rlp.encode([value, self.update_counter])
-            self.db.put(key, _stored_value)
-        else:
-            self.db.delete(key)
+    def update_many(self, items):
+        """
+        applies an iterable of (key, value) updates in order.
+        the journal and index data is buffered and written once on `commit`.
+        results in the same state_digests and files as calling `update` for every item.
+        """
+        _update = self._update
+        for key, value in items:
+            _update(key, value)
 
+    def _update(self, key, value):
+        "updates state and db, buffers the journal entry and the index"
+        old_value, old_counter = self.get_raw(key)
         # generate log
-        log = rlp.encode([key, value, old_counter])
+        log = self._encode([key, value, old_counter])
+        self._check_entry_size(log)
+        self.update_counter += 1
+
+        if self.history:
+            self._add_history(self.update_counter, old_counter, self._reader.read_history)
+
+        # store in leveldb, deleted keys are kept with an empty value
+        _stored_value = self._encode([value, self.update_counter])
+        self.db.put(key, _stored_value)
+
+        self._append_log(log)
+
+    def append_log(self, log):
+        """
+        appends an update given as its log (rlp[key, value, old_counter]) to the journal,
+        w/o updating the db (see `store_values`), e.g. to import a journal.
+        returns (key, value, update_counter)
+        """
+        key, value, old_counter = rlp.decode(log)
+        self._check_entry_size(log)
+        self.update_counter += 1
+        if self.history:
+            self._add_history(self.update_counter, big_endian_to_int(old_counter),
+                              self._reader.read_history)
+        self._append_log(log)
+        return key, value, self.update_counter
+
+    def _check_entry_size(self, log):
+        "raises ValueError if the journal entry of log does not fit into a segment"
+        if self.segment_size and 32 + len(log) + 10 > self.segment_size:
+            journal_entry_length = 32 + len(log) + len(entry_trailer(log))
+            if journal_entry_length > self.segment_size:
+                raise ValueError('journal entry of %d bytes exceeds the segment_size %d' %
+                                 (journal_entry_length, self.segment_size))
 
-        # update state
-        self.state_digest = sha3(self.state_digest + sha3(log))
+    def store_values(self, values):
+        "stores the values {key: (value, update_counter)} in the db, empty values are deletes"
+        for key, (value, update_counter) in values.iteritems():
+            self.db.put(key, self._encode([value, update_counter]))
+
+    def _append_log(self, log):
+        "updates the state with the log of the update at update_counter, buffers the entry"
+        log_hash = self._hash(log)
+        self._pending_logs[self.update_counter] = log
+        self.state_digest = self._next_state_digest(log_hash)
+        if self.digest_mode == 'skiplist':
+            self._pending_digests[self.update_counter] = self.state_digest
+        self._log_hashes_buffer.append(log_hash)
 
         # state_digest | [key, value, old_counter] | journal_entry_length
-        self.journal.write(self.state_digest)
-        self.journal.write(log)
-        journal_entry_length = 32 + len(log) + 2
-        assert journal_entry_length < b16, journal_entry_length
-        self.journal.write(zpad(int_to_big_endian(journal_entry_length), 2))  # 2 bytes
-
-        # write index
-        pos = self.journal.tell()
-        assert pos < b32
-        idx = zpad(int_to_big_endian(pos), 4)  # 4 bytes
-        self.journal_index.write(idx)
-
-        # debug
-        # self.commit()
-        # jr = JournalReader(self.db)
-        # r = jr.read_update(self.update_counter)
-        # assert r['value'] == value
-        # print r
-
-
-    def commit(self):
-        self.journal_index.flush()
-        self.journal.flush()
-        self.db.commit()
+        trailer = entry_trailer(log)
+        journal_entry_length = 32 + len(log) + len(trailer)
+        if self.segment_size and \
+                self.journal_pos + journal_entry_length > (self.segment + 1) * self.segment_size:
+            self._next_segment()
+        self._journal_buffer.append(self.state_digest)
+        self._journal_buffer.append(log)
+        self._journal_buffer.append(trailer)
+
+        # index
+        self.journal_pos += journal_entry_length
+        if self.segment_size:
+            self._index_buffer.append(struct.pack('>Q', self.journal_pos))  # 8 bytes
+        else:
+            assert self.journal_pos < b32
+            self._index_buffer.append(zpad(int_to_big_endian(self.journal_pos), 4))  # 4 bytes
+
+        if self.checkpoint_interval and self.update_counter % self.checkpoint_interval == 0:
+            self._add_checkpoint()
+
+        if self._writer and len(self._index_buffer) >= self.pipeline_chunk_size:
+            self._write_buffers()
+
+    def _add_checkpoint(self):
+        self._checkpoints_buffer.append(struct.pack(self.checkpoint_format, self.update_counter,
+                                                    self.state_digest, self.journal_pos))
+
+    def _next_state_digest(self, log_hash):
+        "returns the state_digest after the update at self.update_counter"
+        if self.digest_mode == 'skiplist':
+            distant_digest = self._digest_at(distant_ancestor(self.update_counter))
+            return H(distant_digest, H(log_hash, self.state_digest))
+        return sha3(self.state_digest + log_hash)
+
+    def _take(self, buf):
+        data = ''.join(buf)
+        del buf[:]
+        return data
+
+    def _write(self, f, *args):
+        "runs the write f(*args), in the JournalWriter if pipelined"
+        if self._writer:
+            self._writer.put(f, *args)
+        else:
+            f(*args)
+
+    def _write_buffers(self, flush=False, fsync=False):
+        "writes the buffered journal entries, log hashes, checkpoints, history and index"
+        chunks = [(name, self._take(buf)) for name, buf in self._buffers]
+        self._write(self._write_files, chunks, flush, fsync)
+
+    def _write_files(self, chunks, flush, fsync):
+        "chunks: [(file attribute, data)]"
+        # journal first, so the index never points past written (or durable) journal bytes
+        for name, data in chunks:
+            fh = getattr(self, name)
+            if fh is None:
+                continue
+            if data:
+                fh.write(data)
+            if flush:
+                fh.flush()
+            if fsync:
+                os.fsync(fh.fileno())
+
+    def commit(self, checkpoint=False):
+        """
+        commits the updates with the configured durability
+        checkpoint: add a checkpoint for the current state (e.g. at block boundaries)
+        """
+        if checkpoint and self.update_counter and (
+                not self._checkpoints_buffer or
+                struct.unpack(self.checkpoint_format, self._checkpoints_buffer[-1])[0] !=
+                self.update_counter):
+            self._add_checkpoint()
+        if self.durability == 'group' and not self.group_commit.due():
+            return
+        self._commit()
+
+    def sync(self):
+        "commits and flushes all pending (e.g. group committed) updates"
+        if self.durability == 'group':
+            self.group_commit.synced()
+        self._commit(flush=True)
+
+    def _commit(self, flush=False):
+        fsync = self.durability in ('fsync', 'group')
+        flush = bool(flush or fsync or self.durability == 'flush' or self._reader)
+        self._write_buffers(flush, fsync)
+        self._write(self.db.commit, True if fsync else None)  # None: the db's durability
+        if self._writer:
+            self._writer.barrier()
+        if self._reader:
+            self._reader.remap()
+        self._pending_digests.clear()
+        self._pending_history.clear()
+        self._pending_logs.clear()
+
+    def close(self):
+        "commits and flushes the pending updates and stops the JournalWriter (if pipelined)"
+        try:
+            self.sync()
+        finally:
+            if self._writer:
+                self._writer.close()
+                self._writer = None
+
+    def fork(self):
+        "returns an in memory MemoryStateJournal based on the current state"
+        return MemoryStateJournal(self)
+
+    def archive(self, finalized_update_counter, block_size=2**16, background=False):
+        """
+        compresses the journal segments before the segment of finalized_update_counter
+        (see `archive_segments`), requires a segmented journal.
+        returns the stats or, if background, the started thread
+        """
+        self.sync()
+        if not background:
+            return archive_segments(self.db.dbfile, finalized_update_counter, block_size)
+        t = threading.Thread(target=archive_segments,
+                             args=(self.db.dbfile, finalized_update_counter, block_size))
+        t.daemon = True
+        t.start()
+        return t
+
+    def get_reader(self):
+        "returns a MmapJournalReader which is remapped on every commit and rollback"
+        if not self._reader:
+            self.sync()
+            self._reader = MmapJournalReader(self.db, instrumented=bool(self._stats))
+        return self._reader
+
+    def stats(self):
+        """
+        returns a snapshot of the timers, counters and histograms (if instrumented)
+        and the stats of the db and the reader
+        """
+        r = dict(update_counter=self.update_counter, journal_pos=self.journal_pos,
+                 db=self.db.stats())
+        if self._stats:
+            r.update(self._stats.snapshot())
+        if self._reader:
+            r['reader'] = self._reader.stats()
+        return r
 
     def delete(self, key):
         "actually deletes the key from the database"
@@ -239,84 +927,521 @@ class StateJournal(object):
         """
         rollback to the state after update_counter based on the local journal
 
+        the reverted updates are read backwards once, while validating their digest chain.
+        every key is restored once to the value before its oldest reverted update
+        and all restorations are committed in one batch.
+
+        verify: validates the state_digest at update_counter
+            starting from the nearest checkpoint
+
         In practice this file based rollback should not be used,
         but instead updates for young blocks which are probably not final yet
         should be held in memory
         """
+        assert self.base_update_counter <= update_counter <= self.update_counter
+        self.sync()
+        jr = self.get_reader()
+        if self.segment_size:
+            segment = jr.segment_of(jr.read_journal_pos(update_counter))[0]
+            assert os.path.exists(segment_fn(self.db.dbfile, segment)), 'segment is archived'
+
         # read log backwards
-        jr = JournalReader(self.db)
-        for uc in reversed(range(update_counter + 1, self.update_counter+1)):
-            u = jr.read_update(uc)
-            key = u['key']
-            # update with old value
-            prev_uc = u['prev_update_counter']
-            if prev_uc > 0:
-                v = jr.read_update(prev_uc)['value']
-                self.db.put(key, v)
+        restore = dict()  # key > prev_update_counter of its oldest reverted update
+        digest_after = self.state_digest
+        log_hash = None  # of the update after uc
+        for uc in xrange(self.update_counter, update_counter, -1):
+            digest, log = jr.read_raw(uc)
+            digest = str(digest)
+            if log_hash:
+                assert jr.next_digest(uc + 1, digest, log_hash) == digest_after
             else:
-                self.db.delete(key)
-            # read state before the update we reverted
-            if uc > 1:
-                state_digest = jr.read_update(uc-1)['state_digest']
-                assert sha3(state_digest, u['log_hash']) == u['state_digest']
-                self.state_digest = state_digest
+                assert digest == digest_after
+            digest_after = digest
+            log_hash = sha3(log)
+            key, value, prev_update_counter = rlp.decode(log)
+            restore[key] = prev_update_counter
+
+        # state before the updates we reverted
+        state_digest = jr.read_digest(update_counter)
+        if log_hash:
+            assert jr.next_digest(update_counter + 1, state_digest, log_hash) == digest_after
+        if verify:
+            cp_uc, cp_digest, _ = jr.nearest_checkpoint(update_counter)
+            assert jr.validate_range(cp_uc + 1, cp_digest, update_counter) == state_digest
+        assert not [uc for uc in restore.values()
+                    if 0 < big_endian_to_int(uc) <= self.base_update_counter], \
+            'can not restore pruned values'
+
+        # restore the old values
+        for key, prev_update_counter in restore.items():
+            prev_update_counter = big_endian_to_int(prev_update_counter)
+            if prev_update_counter:  # the value or the delete
+                value = rlp.decode(jr.read_raw(prev_update_counter)[1])[1]
+                self.db.put(key, rlp.encode([value, prev_update_counter]))
             else:
-                self.state_digest = self.empty_state_digest
+                self.db.delete(key)
+        self.state_digest = state_digest
+        self.update_counter = update_counter
+
+        #  truncate the logfile, index, log hashes and checkpoints
+        self._truncate_journal(jr.read_journal_pos(update_counter))
+        num_updates = update_counter - self.base_update_counter
+        self.journal_index.truncate(num_updates * self.index_entry_size)
+        self.log_hashes.truncate(num_updates * 32)
+        if self.history:
+            self.history.truncate(num_updates * self.history_size)
+        self._truncate_checkpoints(jr, update_counter)
+        self.sync()
+
+    def prune_before(self, update_counter):
+        """
+        removes the journal data of the updates before update_counter (e.g. once final).
+
+        the state_digest after update_counter - 1 is kept as anchor (for skiplist journals
+        also the state_digests of the distant ancestors of later updates),
+        i.e. validations, checkpoints and SSVs start there. update_counters do not change.
+        segmented journals remove the segments before the anchor,
+        unsegmented journals are copied w/o the pruned prefix.
+        the pruned copies of the files are committed by writing the new anchor
+        (see `finish_prune`). other JournalReaders must be recreated.
+
+        note: values last updated before update_counter are kept in the db, but
+            their SSVs and rollbacks restoring them fail. `get_at` (also at update_counters
+            after the anchor) raises IOError('update_counter ... is pruned') if the value
+            at that point was written before update_counter, i.e. it only returns the
+            current values and values written after the anchor.
+        """
+        base = update_counter - 1
+        assert self.base_update_counter <= base <= self.update_counter
+        if base == self.base_update_counter:
+            return
+        self.sync()
+        jr = self.get_reader()
+        dbfile = self.db.dbfile
+        anchor = struct.pack(self.anchor_format, base, jr.read_digest(base),
+                             jr.read_journal_pos(base))
+        if self.digest_mode == 'skiplist':
+            for uc in pruned_ancestors(base):
+                anchor += struct.pack(self.anchor_digest_format, uc, jr.read_digest(uc))
+        num_pruned = base - self.base_update_counter
+        prefixes = [(self.state_journal_index_fn, num_pruned * self.index_entry_size),
+                    (self.state_journal_log_hashes_fn, num_pruned * 32)]
+        if self.history:
+            prefixes.append((self.state_journal_history_fn, num_pruned * self.history_size))
+        if not self.segment_size:
+            prefixes.append((self.state_journal_fn, jr.read_journal_pos(base) - self.journal_base))
+        for fn, offset in prefixes:
+            fn = os.path.join(dbfile, fn)
+            _copy_from(fn, offset, fn + '.pruned')
+        fn = os.path.join(dbfile, self.state_journal_checkpoints_fn)
+        with open(fn + '.pruned', 'wb') as f:
+            for c in jr.read_checkpoints():
+                if c[0] > base:
+                    f.write(struct.pack(self.checkpoint_format, *c))
+        with open(os.path.join(dbfile, self.state_journal_anchor_fn) + '.new', 'wb') as f:
+            f.write(anchor)
+            f.flush()
+            os.fsync(f.fileno())
+        finish_prune(dbfile)
+
+        # reopen the replaced files
+        self._reader = None
+        for name, fn in (('journal_index', self.state_journal_index_fn),
+                         ('log_hashes', self.state_journal_log_hashes_fn),
+                         ('checkpoints', self.state_journal_checkpoints_fn),
+                         ('history', self.state_journal_history_fn),
+                         ('journal', None if self.segment_size else self.state_journal_fn)):
+            if getattr(self, name) is not None and fn:
+                getattr(self, name).close()
+                setattr(self, name, open(os.path.join(dbfile, fn), 'a'))
+        self.base_update_counter = base
+        if not self.segment_size:
+            self.journal_base = jr.read_journal_pos(base)
+        if self.digest_mode == 'skiplist' or self.history:
+            self.get_reader()
+
+
+class MemoryStateJournal(StateJournal):
+    """
+    StateJournal for non final blocks which keeps its updates in memory.
+
+    It is stacked on a parent (a StateJournal or a MemoryStateJournal) and continues
+    its update_counter and state_digest. Reads go through the stack.
+    Forks of the same parent are independent, i.e. switching between
+    sibling branches means switching to another MemoryStateJournal.
+
+    Parents must not be updated while they have children.
+    Once a branch is final, `flush` writes it (and its in memory parents)
+    to the on disk StateJournal.
+    """
+
+    write_batch = True
+
+    def __init__(self, parent):
+        self.parent = parent
+        self.digest_mode = parent.digest_mode
+        self.base_update_counter = self.update_counter = parent.update_counter
+        self.state_digest = parent.state_digest
+        self.updates = []  # (key, value)
+        self.digests = []  # state_digest after each update
+        self.values = dict()  # key > (value, update_counter)
+
+    def stats(self):
+        "returns the stats of the on disk StateJournal"
+        return self.parent.stats()
+
+    def get_raw(self, key):
+        "returns (value, update_counter)"
+        if key in self.values:
+            return self.values[key]
+        return self.parent.get_raw(key)
+
+    def get_at_many(self, keys, update_counter):
+        if update_counter <= self.base_update_counter:
+            return self.parent.get_at_many(keys, update_counter)
+        values = dict()  # key > value after update_counter
+        for key, value in self.updates[:update_counter - self.base_update_counter]:
+            values[key] = value
+        parent_keys = [k for k in keys if k not in values]
+        values.update(zip(parent_keys, self.parent.get_at_many(parent_keys,
+                                                               self.base_update_counter)))
+        return [values[k] for k in keys]
+
+    def iter_prefix(self, prefix):
+        overlay = sorted((k, v[0] or None) for k, v in self.values.items()
+                         if k.startswith(prefix))
+        return merge_sorted(self.parent.iter_prefix(prefix), overlay)
+
+    def _digest_at(self, update_counter):
+        if update_counter > self.base_update_counter:
+            return self.digests[update_counter - self.base_update_counter - 1]
+        return self.parent._digest_at(update_counter)
+
+    def _update(self, key, value):
+        self.update_counter += 1
+        old_value, old_counter = self.get_raw(key)
+        self.values[key] = (value, self.update_counter)
+        log = rlp.encode([key, value, old_counter])
+        self.state_digest = self._next_state_digest(sha3(log))
+        self.updates.append((key, value))
+        self.digests.append(self.state_digest)
+
+    def commit(self, checkpoint=False):
+        pass
+
+    def sync(self):
+        pass
+
+    def rollback(self, update_counter, verify=False):
+        "rollback to the state after update_counter, which must be in this journal"
+        assert self.base_update_counter <= update_counter <= self.update_counter
+        num_updates = update_counter - self.base_update_counter
+        del self.updates[num_updates:]
+        del self.digests[num_updates:]
+        self.update_counter = update_counter
+        self.state_digest = self._digest_at(update_counter) if num_updates else \
+            self.parent.state_digest
+        self.values.clear()
+        for i, (key, value) in enumerate(self.updates, self.base_update_counter + 1):
+            self.values[key] = (value, i)
+
+    def flush(self):
+        """
+        writes the updates of this journal and its in memory parents
+        to the on disk StateJournal and returns it
+        """
+        journals = []
+        sj = self
+        while isinstance(sj, MemoryStateJournal):
+            journals.append(sj)
+            sj = sj.parent
+        assert sj.update_counter == journals[-1].base_update_counter, 'parent was updated'
+        for j in reversed(journals):
+            sj.update_many(j.updates)
+        assert sj.state_digest == self.state_digest
+        sj.commit(checkpoint=True)
+        return sj
 
-        #  truncate the logfile and index
-        self.journal_index.seek((update_counter - 1) * 4)
-        log_end_pos = big_endian_to_int(self.journal_index.read(4))
-        self.journal_index.truncate()
-        self.journal.seek(log_end_pos)
-        self.journal.truncate()
 
-EOF = 2
 class JournalReader(object):
     """
 
     """
 
-    def __init__(self, db):
-        self.journal = open(os.path.join(db.dbfile, StateJournal.state_journal_fn), 'r')
-        self.journal_index = open(os.path.join(db.dbfile, StateJournal.state_journal_index_fn),
+    max_open_segments = 64  # least recently used segments are closed beyond
+
+    def __init__(self, db, instrumented=False):
+        """
+        db: the LevelDB or its path
+        instrumented: time the reads and count the read bytes (see `stats`)
+        """
+        dbfile = self.dbfile = getattr(db, 'dbfile', db)
+        self.segment_size = read_segment_size(dbfile)
+        if self.segment_size:
+            self.index_entry_size = 8
+            self.journal = None
+            self._segments = OrderedDict()  # segment > file, least recently used first
+        else:
+            self.index_entry_size = 4
+            self.journal = open(os.path.join(dbfile, StateJournal.state_journal_fn), 'r')
+        self.journal_index = open(os.path.join(dbfile, StateJournal.state_journal_index_fn),
                                   'r')
+        fn = os.path.join(dbfile, StateJournal.state_journal_log_hashes_fn)
+        self.log_hashes = open(fn, 'r') if os.path.exists(fn) else None
+        self.checkpoints_fn = os.path.join(dbfile, StateJournal.state_journal_checkpoints_fn)
+        fn = os.path.join(dbfile, StateJournal.state_journal_history_fn)
+        self.history = open(fn, 'r') if os.path.exists(fn) else None
+        self.digest_mode = read_digest_mode(dbfile) or 'linear'
+        self.anchor, self.anchor_digests = read_anchor(dbfile)
+        self.base_update_counter = self.anchor[0]
+        self.journal_base = 0 if self.segment_size else self.anchor[2]
+        self._stats = None
+        if instrumented:
+            self._stats = Stats()
+            read = lambda r, *args: {'bytes.journal': 32 + len(r[1])}
+            read_log_hashes = lambda r, *args: {'bytes.log_hashes': len(r)}
+            instrument(self, self._stats, [('read_raw', 'read_raw', False, read),
+                                           ('read_journal_pos', 'read_journal_pos', False, None),
+                                           ('_read_log_hashes', 'read_log_hashes', False,
+                                            read_log_hashes)])
+
+    def stats(self):
+        "returns a snapshot of the timers and counters (if instrumented)"
+        return self._stats.snapshot() if self._stats else dict()
 
     def update_counter(self):
         self.journal_index.seek(0, EOF)
-        return self.journal_index.tell() / 4
+        return self.base_update_counter + self.journal_index.tell() / self.index_entry_size
 
     def last_update(self):
         uc = self.update_counter()
         if uc == 0:
             return {}
+        if uc == self.base_update_counter:
+            return dict(update_counter=uc, state_digest=self.anchor[1])
         return self.read_update(uc)
 
+    def read_journal_pos(self, update_counter):
+        "returns the journal position after update_counter"
+        if update_counter <= self.base_update_counter:
+            if update_counter == self.base_update_counter:
+                return self.anchor[2]
+            raise IOError('update_counter %d is pruned' % update_counter)
+        self.journal_index.seek((update_counter - self.base_update_counter - 1) *
+                                self.index_entry_size)
+        data = self.journal_index.read(self.index_entry_size)
+        if len(data) != self.index_entry_size:
+            raise IOError('no update with update_counter %d' % update_counter)
+        return big_endian_to_int(data)
+
+    def segment_of(self, journal_pos):
+        "returns (segment, position in segment) of the entry ending at journal_pos"
+        segment = max(journal_pos - 1, 0) / self.segment_size
+        return segment, journal_pos - segment * self.segment_size
+
+    def _journal_file(self, journal_pos):
+        "returns the (journal file, position in file) of the entry ending at journal_pos"
+        if not self.segment_size:
+            return self.journal, journal_pos - self.journal_base
+        segment, pos = self.segment_of(journal_pos)
+        f = self._segments.pop(segment, None)
+        if f is None:
+            if len(self._segments) >= self.max_open_segments:
+                self._close_segment(*self._segments.popitem(last=False))
+            fn = segment_fn(self.dbfile, segment)
+            f = open(fn, 'r') if os.path.exists(fn) else ArchivedSegment(fn)
+        self._segments[segment] = f
+        return f, pos
+
+    def _close_segment(self, segment, f):
+        f.close()
+
+    def find_update_counter(self, journal_pos):
+        "returns the first update_counter whose entry ends at or after journal_pos"
+        lo, hi = self.base_update_counter + 1, self.update_counter() + 1
+        while lo < hi:
+            mid = (lo + hi) / 2
+            if self.read_journal_pos(mid) < journal_pos:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def read_history(self, update_counter):
+        "returns the history record (depth, prev_update_counter, jump_update_counter)"
+        if update_counter == 0:
+            return 0, 0, 0
+        if update_counter <= self.base_update_counter:
+            raise IOError('update_counter %d is pruned' % update_counter)
+        self.history.seek((update_counter - self.base_update_counter - 1) *
+                          StateJournal.history_size)
+        data = self.history.read(StateJournal.history_size)
+        if len(data) != StateJournal.history_size:
+            raise IOError('no history for update_counter %d' % update_counter)
+        return struct.unpack(StateJournal.history_format, data)
+
+    def find_update_at(self, update_counter_head, update_counter, read_history=None,
+                       read_log=None):
+        """
+        returns the latest update (or 0) at or before update_counter
+        in the history of a key, which ends with the update at update_counter_head
+        read_history, read_log: replace `read_history` and reading the log with `read_raw`
+            (e.g. to include uncommitted updates)
+        """
+        read_history = read_history or self.read_history
+        read_log = read_log or (lambda uc: self.read_raw(uc)[1])
+        uc = update_counter_head
+        while uc > update_counter:
+            if self.history:
+                _, prev, jump = read_history(uc)
+                uc = jump if jump > update_counter else prev
+            else:
+                uc = big_endian_to_int(rlp.decode(read_log(uc))[2])
+        return uc
+
+    def read_checkpoints(self):
+        "returns the list of (update_counter, state_digest, journal_pos) checkpoints"
+        if not os.path.exists(self.checkpoints_fn):
+            return []
+        data = open(self.checkpoints_fn).read()
+        size = StateJournal.checkpoint_size
+        return [struct.unpack_from(StateJournal.checkpoint_format, data, i)
+                for i in range(0, len(data) - len(data) % size, size)]
+
+    def nearest_checkpoint(self, update_counter):
+        """
+        returns the last checkpoint at or before update_counter
+        the anchor (see `read_anchor`) if there is none
+        """
+        r = self.anchor
+        for c in self.read_checkpoints():
+            if c[0] > update_counter:
+                break
+            r = c
+        return r
+
+    def read_raw(self, update_counter):
+        "returns the (state_digest, log) at update_counter"
+        if 0 < update_counter <= self.base_update_counter:  # incl. the anchor
+            raise IOError('update_counter %d is pruned' % update_counter)
+        journal, log_end_pos = self._journal_file(self.read_journal_pos(update_counter))
+        if isinstance(journal, ArchivedSegment):
+            state_digest, log = parse_entry(*journal.block_at(log_end_pos))
+            return str(state_digest), str(log)
+        journal.seek(log_end_pos - 2)
+        log_len = big_endian_to_int(journal.read(2))
+        trailer_len = 2
+        if log_len == LARGE_ENTRY:
+            journal.seek(log_end_pos - 2 - LARGE_ENTRY)
+            log_len = big_endian_to_int(journal.read(LARGE_ENTRY))
+            trailer_len += LARGE_ENTRY
+        journal.seek(log_end_pos - log_len)
+        state_digest = journal.read(32)  # state_digest after change
+        log = journal.read(-32 + log_len - trailer_len)
+        return state_digest, log
+
+    def _read_log_hashes(self, start, end):
+        "returns the persisted log hashes for update counters start..end as a string"
+        if not self.log_hashes:
+            return ''
+        self.log_hashes.seek((start - self.base_update_counter - 1) * 32)
+        return self.log_hashes.read((end - start + 1) * 32)
+
+    def read_log_hashes(self, update_counter_start, update_counter_end=None):
+        "returns the log hashes for update counters start..end (default: last update)"
+        if update_counter_end is None:
+            update_counter_end = self.update_counter()
+        data = self._read_log_hashes(update_counter_start, update_counter_end)
+        hashes = [data[i:i + 32] for i in range(0, len(data) - len(data) % 32, 32)]
+        # hash logs which are not persisted in the log hashes file
+        hashes.extend(sha3_many(self.read_raw(uc)[1] for uc in
+                                range(update_counter_start + len(hashes), update_counter_end + 1)))
+        return hashes
+
+    def read_digest(self, update_counter):
+        "returns the state_digest after update_counter"
+        if update_counter in self.anchor_digests:
+            return self.anchor_digests[update_counter]
+        return str(self.read_raw(update_counter)[0])
+
+    def read_log_hash(self, update_counter):
+        return self.read_log_hashes(update_counter, update_counter)[0]
+
     def read_update(self, update_counter):
         "first update has update_counter=1"
         # assert update_counter > 0
-        self.journal_index.seek((update_counter - 1) * 4)
-        log_end_pos = big_endian_to_int(self.journal_index.read(4))
-        self.journal.seek(log_end_pos - 2)
-        log_len = big_endian_to_int(self.journal.read(2))
-        self.journal.seek(-log_len, 1)
-        state_digest = self.journal.read(32)  # state_digest after change
-        log = self.journal.read(-32 + log_len - 2)
+        state_digest, log = self.read_raw(update_counter)
         key, value, prev_update_counter = rlp.decode(log)
         prev_update_counter = big_endian_to_int(prev_update_counter)
+        log_hash = self._read_log_hashes(update_counter, update_counter) or sha3(log)
         return dict(key=key, value=value, prev_update_counter=prev_update_counter,
-                    state_digest=state_digest, log_hash=sha3(log), update_counter=update_counter)
-
-    def validate_state(self, last_update_counter):
-        state_digest = StateJournal.empty_state_digest
-        for i in range(1, last_update_counter+1):
-            l = self.read_update(i)
-            assert sha3(state_digest + l['log_hash']) == l['state_digest']
-            state_digest = l['state_digest']
+                    state_digest=str(state_digest), log_hash=log_hash,
+                    update_counter=update_counter)
+
+    def validate_state(self, last_update_counter, use_log_hashes=False, spot_checks=0,
+                       trust_checkpoints=False):
+        """
+        validates the chain of state_digests up to last_update_counter
+
+        use_log_hashes: trust the persisted log hashes instead of hashing every log,
+            only the final state_digest is compared with the journal
+        spot_checks: number of randomly picked updates for which the log hash
+            and state_digest are verified against the journal (if use_log_hashes)
+        trust_checkpoints: start at the nearest checkpoint instead of the first update
+        """
+        base, state_digest, _ = self.anchor
+        if trust_checkpoints:
+            cp_uc, state_digest, _ = self.nearest_checkpoint(last_update_counter)
+            return self.validate_range(cp_uc + 1, state_digest, last_update_counter)
+        if self.digest_mode == 'skiplist' or not use_log_hashes:
+            return self.validate_range(base + 1, state_digest, last_update_counter)
+
+        checks = set(random.sample(xrange(base + 1, last_update_counter + 1),
+                                   min(spot_checks, last_update_counter - base)))
+        checks.add(last_update_counter)
+        for i, log_hash in enumerate(self.read_log_hashes(base + 1, last_update_counter),
+                                     base + 1):
+            state_digest = sha3(state_digest + log_hash)
+            if i in checks:
+                digest, log = self.read_raw(i)
+                assert sha3(log) == log_hash
+                assert state_digest == str(digest)
+        return state_digest
+
+    def next_digest(self, update_counter, state_digest, log_hash):
+        """
+        returns the state_digest after the update at update_counter,
+        given the state_digest before and the log_hash of the update
+        """
+        if self.digest_mode == 'skiplist':
+            distant_digest = self.read_digest(distant_ancestor(update_counter))
+            return H(distant_digest, H(log_hash, state_digest))
+        return sha3(state_digest + log_hash)
+
+    def validate_range(self, update_counter_start, state_digest, update_counter_end):
+        """
+        validates the updates update_counter_start..update_counter_end
+        starting with the state_digest before update_counter_start.
+        returns the state_digest after update_counter_end
+        """
+        read_raw = self.read_raw
+        if self.digest_mode == 'skiplist':
+            for i in range(update_counter_start, update_counter_end+1):
+                digest, log = read_raw(i)
+                # distant digests are validated in previous iterations (or ranges)
+                state_digest = self.next_digest(i, state_digest, sha3(log))
+                assert state_digest == str(digest)
+            return state_digest
+        for i in range(update_counter_start, update_counter_end+1):
+            digest, log = read_raw(i)
+            state_digest = sha3(state_digest + sha3(log))
+            assert state_digest == str(digest)
         return state_digest
 
-    def get_ssv(self, update_counter_start):
+    def get_ssv(self, update_counter_start, update_counter_end=None):
         """
-        returns all hashes from a given value up to the current state.
+        returns all hashes from a given value up to the current state
+        (or the state at update_counter_end).
         recursively hasing them up should lead to the current state root.
 
         note: the user first needs to know or query and trust
@@ -326,22 +1451,386 @@ class JournalReader(object):
 
         PoC implementation is O(n), but can be changed to O(log(n)) by
             - adding state_digests to txs and (tree like) for blocks
+        see `get_ssv_log` for journals in the 'skiplist' digest mode
         """
+        assert self.digest_mode == 'linear', 'use get_ssv_log'
 
         # read the update
         r = self.read_update(update_counter_start)
-        if update_counter_start == 1:
-            prev_state_digest = StateJournal.empty_state_digest
+        prev_state_digest = self.read_digest(update_counter_start - 1)
+        r['hash_chain'] = [prev_state_digest]
+        r['hash_chain'].extend(self.read_log_hashes(update_counter_start, update_counter_end))
+        return r
+
+    def get_ssv_log(self, update_counter, update_counter_end=None):
+        """
+        returns the update at update_counter and an O(log(n)) proof in `r['proof']`,
+        for journals in the 'skiplist' digest mode.
+
+        the first element of the proof is the log_hash of the update,
+        `evaluate_ssv_log(proof)` should lead to the current state_digest
+        (or the one at update_counter_end).
+        """
+        assert self.digest_mode == 'skiplist', 'use get_ssv'
+        r = self.read_update(update_counter)
+        if update_counter_end is None:
+            update_counter_end = self.update_counter()
+        path = get_path(update_counter_end, update_counter)
+        path.pop(-1)
+        path.reverse()
+        digest = self.read_digest
+        hashes = [r['log_hash'], digest(update_counter - 1),
+                  digest(distant_ancestor(update_counter))]
+        for is_distant, number in path:
+            if is_distant:
+                # merge to distant digest
+                hashes.append(H(self.read_log_hash(number), digest(number - 1)))
+            else:  # merge to prev digest
+                hashes.append(self.read_log_hash(number))
+                hashes.append(digest(distant_ancestor(number)))
+        r['proof'] = hashes
+        return r
+
+
+class MmapJournalReader(JournalReader):
+    """
+    JournalReader which memory maps the journal and the index.
+    Entries are located by slicing the maps, i.e. w/o seek and read syscalls.
+
+    The maps are extended when an update_counter beyond the mapped index is requested.
+    Segments of segmented journals are mapped on first access.
+    After truncating the journal (rollback) `remap` must be called,
+    which is done automatically for the reader returned by `StateJournal.get_reader`.
+    """
+
+    def __init__(self, db, instrumented=False):
+        super(MmapJournalReader, self).__init__(db, instrumented)
+        self._journal_map = self._index_map = self._log_hashes_map = None
+        self._segment_maps = dict()  # segment > map
+        self._index_format = '>Q' if self.segment_size else '>I'
+        self._num_updates = 0
+        self.remap()
+
+    def _map(self, fh):
+        size = os.fstat(fh.fileno()).st_size
+        if size == 0:
+            return None
+        return mmap.mmap(fh.fileno(), size, access=mmap.ACCESS_READ)
+
+    def remap(self):
+        "maps the current size of journal, index and log hashes"
+        maps = [self._journal_map, self._index_map, self._log_hashes_map]
+        for m in maps + self._segment_maps.values():
+            if m is not None:
+                m.close()
+        if self.segment_size:
+            # segments might have been removed and recreated
+            for fh in self._segments.values():
+                fh.close()
+            self._segments.clear()
+            self._segment_maps.clear()
         else:
-            prev_state_digest = self.read_update(update_counter_start - 1)['state_digest']
-        r['hash_chain'] = [prev_state_digest, r['log_hash']]
-        update_counter = update_counter_start + 1
+            self._journal_map = self._map(self.journal)
+        self._index_map = self._map(self.journal_index)
+        self._log_hashes_map = self._map(self.log_hashes) if self.log_hashes else None
+        self._num_updates = self.base_update_counter + (
+            len(self._index_map) / self.index_entry_size if self._index_map else 0)
+
+    def _journal_map_at(self, journal_pos):
+        "returns the (map, position in map) of the entry ending at journal_pos"
+        if not self.segment_size:
+            return self._journal_map, journal_pos - self.journal_base
+        segment, pos = self.segment_of(journal_pos)
+        journal = self._journal_file(journal_pos)[0]  # keeps the segment open
+        if isinstance(journal, ArchivedSegment):
+            return journal.block_at(pos)
+        m = self._segment_maps.get(segment)
+        if m is None or len(m) < pos:
+            if m is not None:
+                m.close()
+            m = self._segment_maps[segment] = self._map(journal)
+        return m, pos
+
+    def _close_segment(self, segment, f):
+        # not closed, as buffers returned by read_raw might still use the map
+        self._segment_maps.pop(segment, None)
+        f.close()
+
+    def update_counter(self):
+        self.remap()
+        return self._num_updates
+
+    def read_journal_pos(self, update_counter):
+        if update_counter <= self.base_update_counter:
+            return JournalReader.read_journal_pos(self, update_counter)
+        if update_counter > self._num_updates:
+            self.remap()
+            if update_counter > self._num_updates:
+                raise IOError('no update with update_counter %d' % update_counter)
+        return struct.unpack_from(self._index_format, self._index_map,
+                                  (update_counter - self.base_update_counter - 1) *
+                                  self.index_entry_size)[0]
+
+    def read_raw(self, update_counter):
+        """
+        returns zero copy buffers of the (state_digest, log) at update_counter
+        note: buffers are invalid after the next remap
+        """
+        if 0 < update_counter <= self.base_update_counter:
+            raise IOError('update_counter %d is pruned' % update_counter)
+        if not self.base_update_counter < update_counter <= self._num_updates:
+            self.remap()
+            if not self.base_update_counter < update_counter <= self._num_updates:
+                raise IOError('no update with update_counter %d' % update_counter)
+        log_end_pos, = struct.unpack_from(self._index_format, self._index_map,
+                                          (update_counter - self.base_update_counter - 1) *
+                                          self.index_entry_size)
+        return parse_entry(*self._journal_map_at(log_end_pos))
+
+    def _read_log_hashes(self, start, end):
+        if end > self._num_updates:
+            self.remap()
+        if not self._log_hashes_map:
+            return ''
+        base = self.base_update_counter
+        return self._log_hashes_map[(start - base - 1) * 32:(end - base) * 32]
+
+
+def _validate_range(args):
+    "process pool worker"
+    dbfile, start, state_digest, end = args
+    jr = MmapJournalReader(dbfile)
+    return start, end, jr.validate_range(start, state_digest, end)
+
+
+def boundary_digests(jr, boundaries):
+    """
+    cheap pass which returns the state_digests at the update_counters in `boundaries`.
+    for linear journals they are computed from the persisted log hashes
+    (i.e. w/o reading the journal), skiplist journals read them from the journal.
+    """
+    if jr.digest_mode == 'skiplist':
+        return [(uc, jr.read_digest(uc)) for uc in boundaries]
+    digests = []
+    last, state_digest, _ = jr.anchor
+    for uc in boundaries:
+        for log_hash in jr.read_log_hashes(last + 1, uc) if uc > last else []:
+            state_digest = sha3(state_digest + log_hash)
+        digests.append((uc, state_digest))
+        last = uc
+    return digests
+
+
+def validate_state_parallel(db, last_update_counter, processes=None, num_ranges=None,
+                            checkpoints=None, progress=None):
+    """
+    validates the journal up to last_update_counter in a process pool
+
+    the journal is split into ranges which are bounded by (update_counter, state_digest)
+    `checkpoints`, by default the persisted checkpoints. if there are none
+    the boundaries are computed in a cheap first pass.
+    every range is validated by a worker, which must end with the state_digest
+    the next range starts from.
+
+    progress: callable(validated_updates, last_update_counter, elapsed_seconds)
+
+    returns the state_digest after last_update_counter
+    """
+    dbfile = getattr(db, 'dbfile', db)
+    processes = processes or multiprocessing.cpu_count()
+    num_ranges = num_ranges or processes * 4
+    jr = JournalReader(dbfile)
+    base = jr.base_update_counter
+    if checkpoints is None:
+        persisted = [c[:2] for c in jr.read_checkpoints() if c[0] < last_update_counter]
+        if len(persisted) >= num_ranges - 1:
+            checkpoints = sorted(set(persisted[len(persisted) * i / num_ranges]
+                                     for i in range(1, num_ranges)))
+    if checkpoints is None:
+        boundaries = sorted(set(base + (last_update_counter - base) * i / num_ranges
+                                for i in range(1, num_ranges)))
+        checkpoints = boundary_digests(MmapJournalReader(dbfile), boundaries)
+    checkpoints = sorted(c for c in checkpoints if base < c[0] < last_update_counter)
+    checkpoints = [jr.anchor[:2]] + checkpoints + [(last_update_counter, None)]
+
+    expected = dict()  # start > state_digest after the range
+    tasks = []
+    for (start, start_digest), (end, end_digest) in zip(checkpoints, checkpoints[1:]):
+        expected[start + 1] = end_digest
+        tasks.append((dbfile, start + 1, start_digest, end))
+
+    st = time.time()
+    validated = 0
+    state_digest = None
+    pool = multiprocessing.Pool(processes)
+    try:
+        for start, end, digest in pool.imap_unordered(_validate_range, tasks):
+            assert expected[start] in (None, digest), 'range %d..%d does not chain' % (start, end)
+            if end == last_update_counter:
+                state_digest = digest
+            validated += end - start + 1
+            if progress:
+                progress(validated, last_update_counter, time.time() - st)
+    finally:
+        pool.terminate()
+    return state_digest
+
+
+def _rebuild_range(args):
+    """
+    process pool worker, scans the updates start..end backwards
+    returns the latest (key, update_counter, value) of the keys updated in the range,
+    value is '' if the key was deleted
+    """
+    dbfile, start, end = args
+    jr = MmapJournalReader(dbfile)
+    latest = dict()
+    for uc in xrange(end, start - 1, -1):
+        key, value, _ = rlp.decode(jr.read_raw(uc)[1])
+        if key not in latest:
+            latest[key] = (uc, value)
+    return [(key, uc, value) for key, (uc, value) in latest.iteritems()]
+
+
+def rebuild_state_parallel(db, last_update_counter=None, processes=None, num_ranges=None,
+                           verify=True, progress=None):
+    """
+    rebuilds the state db (i.e. the values) from the journal up to last_update_counter
+    (default: the last update), e.g. after a fast sync of the journal or a lost state db
+
+    - verify: validates the journal first (see validate_state_parallel)
+    - the journal is split into num_ranges update_counter ranges, every worker
+      returns the latest values of the keys updated in its range
+    - the value with the highest update_counter of every key is written to db
+      in batches, including the deletes (see `StateJournal.get_raw`)
+
+    progress: callable(merged_ranges, num_ranges, elapsed_seconds)
+    returns the number of keys in the journal
+    note: keys last updated before the anchor of a pruned journal are not changed
+    """
+    dbfile = db.dbfile
+    jr = JournalReader(dbfile)
+    if last_update_counter is None:
+        last_update_counter = jr.update_counter()
+    if verify and last_update_counter:
+        validate_state_parallel(dbfile, last_update_counter, processes)
+    processes = processes or multiprocessing.cpu_count()
+    num_ranges = num_ranges or processes
+    base = jr.base_update_counter
+    boundaries = sorted(set(base + (last_update_counter - base) * i / num_ranges
+                            for i in range(num_ranges + 1)))
+    tasks = [(dbfile, start + 1, end) for start, end in zip(boundaries, boundaries[1:])]
+    st = time.time()
+    latest = dict()  # key > (update_counter, value)
+    pool = multiprocessing.Pool(processes)
+    try:
+        for i, updates in enumerate(pool.imap_unordered(_rebuild_range, tasks), 1):
+            for key, uc, value in updates:
+                if uc > latest.get(key, (0,))[0]:
+                    latest[key] = (uc, value)
+            if progress:
+                progress(i, len(tasks), time.time() - st)
+    finally:
+        pool.terminate()
+    for key, (uc, value) in sorted(latest.iteritems()):
+        db.put(key, rlp.encode([value, uc]))
+        if len(db.uncommitted) >= 100000:
+            db.commit()
+    db.commit()
+    return len(latest)
+
+
+class ArchivedSegment(object):
+    """
+    journal segment which is compressed into independently decompressible zlib blocks.
+    blocks contain whole entries, so reading an entry decompresses one block.
+
+        data (segment_fn.z): zlib(block0) | zlib(block1) | ...
+        block index (segment_fn.zi): uncompressed_end[8] | compressed_end[8] per block
+    """
+    data_ext = '.z'
+    index_ext = '.zi'
+    index_format = '>QQ'
+
+    def __init__(self, fn):
+        self.data = open(fn + self.data_ext, 'r')
+        index = open(fn + self.index_ext).read()
+        size = struct.calcsize(self.index_format)
+        entries = [struct.unpack_from(self.index_format, index, i)
+                   for i in range(0, len(index), size)]
+        self.ends = [e[0] for e in entries]
+        self.compressed_ends = [e[1] for e in entries]
+        self._block_num = self._block = None
+
+    def block_at(self, pos):
+        "returns the (decompressed block, position in block) of the entry ending at pos"
+        i = bisect.bisect_left(self.ends, pos)
+        start = self.ends[i - 1] if i else 0
+        if i != self._block_num:
+            compressed_start = self.compressed_ends[i - 1] if i else 0
+            self.data.seek(compressed_start)
+            self._block = zlib.decompress(self.data.read(self.compressed_ends[i] -
+                                                         compressed_start))
+            self._block_num = i
+        return self._block, pos - start
+
+    def close(self):
+        self.data.close()
+
+    @classmethod
+    def create(cls, fn, entry_ends, block_size):
+        """
+        archives the segment file fn, whose entries end at entry_ends, and deletes it.
+        returns the (raw size, archived size, number of blocks)
+        """
+        raw = open(fn).read()
+        data, index = [], []
+        start = compressed_end = 0
+        for i, end in enumerate(entry_ends):
+            if end - start < block_size and i < len(entry_ends) - 1:
+                continue
+            block = zlib.compress(raw[start:end])
+            compressed_end += len(block)
+            data.append(block)
+            index.append(struct.pack(cls.index_format, end, compressed_end))
+            start = end
+        for ext, content in ((cls.data_ext, data), (cls.index_ext, index)):
+            with open(fn + ext + '.tmp', 'w') as f:
+                f.write(''.join(content))
+            os.rename(fn + ext + '.tmp', fn + ext)
+        os.remove(fn)
+        return len(raw), compressed_end + len(index) * struct.calcsize(cls.index_format), \
+            len(index)
+
+
+def archive_segments(dbfile, finalized_update_counter, block_size=2**16):
+    """
+    compresses the raw journal segments before the segment of finalized_update_counter
+    into ArchivedSegments, which only need to decompress one block per read_update.
+    returns stats: dict(segments, raw_bytes, archived_bytes, blocks)
+    """
+    jr = JournalReader(dbfile)
+    assert jr.segment_size, 'only segmented journals can be archived'
+    stats = dict(segments=0, raw_bytes=0, archived_bytes=0, blocks=0)
+    if not finalized_update_counter:
+        return stats
+    last_segment = jr.segment_of(jr.read_journal_pos(finalized_update_counter))[0]
+    for segment in range(last_segment):
+        fn = segment_fn(dbfile, segment)
+        if not os.path.exists(fn):  # archived
+            continue
+        base = segment * jr.segment_size
+        entry_ends = []
+        uc = jr.find_update_counter(base + 1)
         while True:
-            try:
-                u = self.read_update(update_counter)
-            except IOError:
+            pos = jr.read_journal_pos(uc) - base
+            if pos > jr.segment_size:
                 break
-            r['hash_chain'].append(u['log_hash'])
-            update_counter += 1
-        return r
-
+            entry_ends.append(pos)
+            uc += 1
+        raw_size, archived_size, blocks = ArchivedSegment.create(fn, entry_ends, block_size)
+        stats['segments'] += 1
+        stats['raw_bytes'] += raw_size
+        stats['archived_bytes'] += archived_size
+        stats['blocks'] += blocks
+    return stats
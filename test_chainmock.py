@@ -0,0 +1,12 @@
+import chainmock
+from utils import generate_workload
+
+
+def test_blocks_beyond_workload(tmpdir):
+    chain = chainmock.get_statejournal_chain(str(tmpdir),
+                                             generate_workload(chainmock.config, 2))
+    chainmock.test_add_blocks(chain, 3)
+    assert chain.num_blocks == 3
+    assert chain.workload_at('txs_per_block', 2) == \
+        int(chainmock.config['txs_per_block'](2))
+    assert chain.num_txs == sum(chain.workload_at('txs_per_block', i) for i in range(3))
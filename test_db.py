@@ -0,0 +1,110 @@
+from db import LevelDB, ReadCache, codecs, prefix_end
+
+
+def test_read_cache():
+    for eviction in ReadCache.evictions:
+        c = ReadCache(3, eviction)
+        for k in 'abc':
+            c.put(k, k)
+        assert c.get('a') == 'a'
+        c.put('d', 'd')
+        assert len(c) == 3
+        if eviction == 'lru':
+            assert c.get('b') is None and c.get('a') == 'a'
+        else:
+            assert c.get('a') is None and c.get('b') == 'b'
+    assert (c.hits, c.misses) == (2, 1)
+    c = ReadCache(0)
+    c.put('a', 'a')
+    assert c.get('a') is None
+
+
+def test_commit_writes_dirty_keys(tmpdir):
+    db = LevelDB(str(tmpdir), cache_size=10)
+    for i in range(100):
+        db.put(str(i), str(i))
+    db.commit()
+    assert db.uncommitted == {}
+
+    # reads are cached, but not written on commit
+    for i in range(100):
+        assert db.get(str(i)) == str(i)
+    assert db.uncommitted == {}
+    assert len(db.cache) == 10
+    assert db.cache.misses == 100
+    assert db.get('99') == '99'
+    assert db.cache.hits == 1
+
+    # writes invalidate the cache
+    db.put('99', 'x')
+    db.delete('98')
+    assert db.get('99') == 'x'
+    assert '98' not in db
+    assert db.uncommitted == {'99': 'x', '98': None}
+    db.commit()
+    assert db.get('99') == 'x'
+    assert '98' not in db
+
+
+def test_codecs(tmpdir):
+    values = dict((str(i) * 10, '\x00' * 30 + str(i) * 20) for i in range(100))
+    for value_codec in codecs:
+        for key_codec in codecs:
+            db = LevelDB(str(tmpdir.join(value_codec + key_codec)), cache_size=0,
+                         value_codec=value_codec, key_codec=key_codec)
+            for k, v in values.items():
+                db.put(k, v)
+            db.commit()
+            for k, v in values.items():
+                assert db.get(k) == v
+            db.delete(k)
+            db.commit()
+            assert k not in db
+
+
+def test_group_commit(tmpdir):
+    db = LevelDB(str(tmpdir), durability='group', group_commit_blocks=3)
+    syncs = []
+    write = db.db.Write
+    db.db = type('DB', (object,), dict(
+        Write=lambda self, batch, sync: (syncs.append(sync), write(batch, sync=sync)),
+        Get=lambda self, key: db.db.Get(key)))()
+    for i in range(6):
+        db.put(str(i), str(i))
+        db.commit()
+    assert syncs == [False, False, True] * 2
+    db.commit(sync=True)
+    assert syncs[-1] is True
+
+
+def test_range_iter(tmpdir):
+    db = LevelDB(str(tmpdir))
+    for k in ('a', 'ab', 'abc', 'ac', 'b', 'a\xff', 'a\xff\xff'):
+        db.put(k, k.upper())
+    db.commit()
+    db.delete('abc')
+    db.put('aa', 'AA')
+    db.put('ab', 'X')
+    assert list(db.range_iter('a', 'b')) == [
+        ('a', 'A'), ('aa', 'AA'), ('ab', 'X'), ('ac', 'AC'), ('a\xff', 'A\xff'),
+        ('a\xff\xff', 'A\xff\xff')]
+    assert [k for k, v in db.range_iter('ab', prefix_end('ab'))] == ['ab']
+    assert [k for k, v in db.range_iter('a\xff', prefix_end('a\xff'))] == ['a\xff', 'a\xff\xff']
+    assert [k for k, v in db.range_iter('ac')] == ['ac', 'a\xff', 'a\xff\xff', 'b']
+    assert prefix_end('\xff') is None
+
+
+def test_stats(tmpdir):
+    db = LevelDB(str(tmpdir.join('plain')))
+    assert 'get' not in db.__dict__  # uninstrumented dbs run the plain methods
+    db = LevelDB(str(tmpdir.join('instrumented')), instrumented=True)
+    db.put('a', 'xyz')
+    db.commit()
+    db.get('a')
+    db.get('a')
+    s = db.stats()
+    assert (s['reads'], s['writes'], s['commits']) == (2, 1, 1)
+    assert s['cache_hit_rate'] == 0.5
+    assert s['timers']['get']['calls'] == 2
+    assert s['counters']['bytes.put'] == 4
+    assert sum(c for _, c in s['histograms']['commit']) == 1
@@ -0,0 +1,54 @@
+import os
+from StringIO import StringIO
+from ethereum.utils import sha3, int_to_big_endian
+from db import LevelDB
+from statejournal import StateJournal
+from fastsync import export_journal, import_journal
+
+
+def get_journal(path, **kargs):
+    sj = StateJournal(LevelDB(path), **kargs)
+    updates = []
+    for i in range(1, 3001):
+        value = int_to_big_endian(i) if i % 7 else ''
+        if i % 1000 == 0:
+            value *= 70000  # large entry
+        updates.append((sha3(str(i % 300)), value))
+    sj.update_many(updates)
+    sj.commit()
+    return sj
+
+
+def test_export_import(tmpdir):
+    for digest_mode in StateJournal.digest_modes:
+        sj = get_journal(str(tmpdir.join(digest_mode)), digest_mode=digest_mode)
+        out = StringIO()
+        assert export_journal(sj.db, out) == 3000
+        if digest_mode == 'linear':
+            journal = open(os.path.join(sj.db.dbfile, StateJournal.state_journal_fn)).read()
+            assert out.getvalue() == 'statejournal linear\n' + journal
+
+        path = str(tmpdir.join(digest_mode + '_synced'))
+        progress = []
+        synced = import_journal(LevelDB(path), StringIO(out.getvalue()), batch_size=1000,
+                                progress=lambda n, elapsed: progress.append(n),
+                                segment_size=2**20, history=True)
+        assert progress == [1000, 2000, 3000]
+        for uc in (1, 1000, 2950):
+            assert synced.get_at(sha3('1'), uc) == sj.get_at(sha3('1'), uc)
+        assert (synced.update_counter, synced.state_digest) == (3000, sj.state_digest)
+        assert list(synced.db.range_iter()) == list(sj.db.range_iter())
+        assert synced.get_reader().validate_state(3000) == sj.state_digest
+
+
+def test_import_tampered(tmpdir):
+    sj = get_journal(str(tmpdir.join('a')))
+    out = StringIO()
+    export_journal(sj.db, out)
+    data = out.getvalue()
+    for i, tampered in enumerate((data[:-1], data[:500] + chr(ord(data[500]) ^ 1) + data[501:])):
+        try:
+            import_journal(LevelDB(str(tmpdir.join(str(i)))), StringIO(tampered))
+            assert False
+        except IOError:
+            pass
@@ -0,0 +1,11 @@
+from ethereum.utils import sha3
+import hashing
+
+
+def test_backends():
+    assert hashing.sha3 == hashing.backends[hashing.backend]
+    data = ['', 'abc', 'x' * 100000]
+    for name, hash_fn in hashing.backends.items():
+        assert [hash_fn(d) for d in data] == [sha3(d) for d in data], name
+        assert hash_fn(buffer('xabc', 1)) == sha3('abc'), name
+    assert hashing.sha3_many(data) == [sha3(d) for d in data]
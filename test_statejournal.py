@@ -0,0 +1,794 @@
+import os
+import rlp
+from ethereum.utils import sha3, int_to_big_endian
+from db import LevelDB
+from statejournal import StateJournal, MemoryStateJournal, JournalReader, MmapJournalReader
+from statejournal import evaluate_ssv_log, validate_state_parallel, segment_fn
+from statejournal import rebuild_state_parallel, pruned_ancestors, finish_prune
+from proofofexistence.notary import distant_ancestor
+
+
+def get_updates(num_updates, num_keys=50):
+    "deterministic updates incl. overwrites and deletes"
+    updates = []
+    for i in range(1, num_updates + 1):
+        key = sha3(str(i % num_keys))
+        value = int_to_big_endian(i) if i % 7 else ''
+        updates.append((key, value))
+    return updates
+
+
+def get_journal(path, **kargs):
+    return StateJournal(LevelDB(path), **kargs)
+
+
+def read_files(path):
+    return [open(os.path.join(path, fn)).read()
+            for fn in (StateJournal.state_journal_fn, StateJournal.state_journal_index_fn)]
+
+
+def test_update_many(tmpdir):
+    updates = get_updates(500)
+    path_a = str(tmpdir.join('a'))
+    path_b = str(tmpdir.join('b'))
+    sj_a = get_journal(path_a)
+    sj_b = get_journal(path_b)
+
+    for block in range(5):
+        block_updates = updates[block * 100:(block + 1) * 100]
+        for k, v in block_updates:
+            sj_a.update(k, v)
+        sj_a.commit()
+        sj_b.update_many(block_updates)
+        sj_b.commit()
+        assert sj_a.update_counter == sj_b.update_counter
+        assert sj_a.state_digest == sj_b.state_digest
+
+    assert read_files(path_a) == read_files(path_b)
+    jr = JournalReader(sj_b.db)
+    assert jr.validate_state(sj_b.update_counter) == sj_b.state_digest
+    for k, v in updates[-50:]:
+        assert sj_b.get(k) == v
+
+
+def test_write_batch(tmpdir):
+    updates = get_updates(300)
+    path_a = str(tmpdir.join('a'))
+    path_b = str(tmpdir.join('b'))
+    sj_a = get_journal(path_a)
+    sj_b = get_journal(path_b, write_batch=True)
+    for k, v in updates:
+        sj_a.update(k, v)
+        sj_b.update(k, v)
+    sj_b.update_many(get_updates(20))
+    sj_a.update_many(get_updates(20))
+    sj_a.commit()
+    sj_b.commit()
+    assert sj_a.state_digest == sj_b.state_digest
+    assert read_files(path_a) == read_files(path_b)
+
+    # reopen and continue
+    sj_c = StateJournal(sj_b.db, write_batch=True)
+    assert sj_c.update_counter == sj_b.update_counter
+    assert sj_c.state_digest == sj_b.state_digest
+
+
+def test_mmap_reader(tmpdir):
+    sj = get_journal(str(tmpdir))
+    jr = sj.get_reader()
+    assert jr.update_counter() == 0
+    assert jr.last_update() == {}
+    updates = get_updates(300)
+    sj.update_many(updates[:200])
+    sj.commit()  # remaps
+    assert jr.last_update()['state_digest'] == sj.state_digest
+    sj.update_many(updates[200:])
+    sj.commit()
+
+    standalone = MmapJournalReader(sj.db)
+    file_reader = JournalReader(sj.db)
+    assert standalone.update_counter() == file_reader.update_counter() == 300
+    for uc in (1, 2, 150, 299, 300):
+        assert jr.read_update(uc) == file_reader.read_update(uc)
+    assert jr.validate_state(300) == file_reader.validate_state(300) == sj.state_digest
+    assert jr.get_ssv(250) == file_reader.get_ssv(250)
+
+    # standalone reader extends its maps on growth
+    sj.update_many(get_updates(10))
+    sj.commit()
+    assert standalone.read_update(310)['state_digest'] == sj.state_digest
+
+
+def test_log_hashes(tmpdir):
+    path = str(tmpdir)
+    sj = get_journal(path)
+    sj.update_many(get_updates(200))
+    sj.commit()
+    lh_fn = os.path.join(path, StateJournal.state_journal_log_hashes_fn)
+    assert os.path.getsize(lh_fn) == 200 * 32
+
+    for jr in (JournalReader(sj.db), sj.get_reader()):
+        hashes = jr.read_log_hashes(1)
+        assert hashes == [sha3(str(jr.read_raw(uc)[1])) for uc in range(1, 201)]
+        assert jr.read_log_hashes(10, 20) == hashes[9:20]
+        assert jr.validate_state(200, use_log_hashes=True, spot_checks=20) == sj.state_digest
+        ssv = jr.get_ssv(150, 180)
+        s = ssv['hash_chain'][0]
+        for h in ssv['hash_chain'][1:]:
+            s = sha3(s + h)
+        assert s == jr.read_update(180)['state_digest']
+
+    # journals w/o log hashes get them added on startup
+    os.remove(lh_fn)
+    assert JournalReader(sj.db).read_log_hashes(1) == hashes
+    sj = StateJournal(sj.db)
+    assert open(lh_fn).read() == ''.join(hashes)
+
+
+def test_log_hashes_tampered(tmpdir):
+    sj = get_journal(str(tmpdir))
+    sj.update_many(get_updates(50))
+    sj.commit()
+    lh_fn = os.path.join(str(tmpdir), StateJournal.state_journal_log_hashes_fn)
+    data = open(lh_fn).read()
+    open(lh_fn, 'w').write(data[:32 * 10] + sha3('x') + data[32 * 11:])
+    jr = JournalReader(sj.db)
+    jr.validate_state(50)  # ignores log hashes
+    try:
+        jr.validate_state(50, use_log_hashes=True)
+    except AssertionError:
+        pass
+    else:
+        assert False, 'tampered log hash not detected'
+
+
+def test_skiplist_ssv(tmpdir):
+    sj = get_journal(str(tmpdir), digest_mode='skiplist')
+    updates = get_updates(1000)
+    for i in range(0, 1000, 300):
+        sj.update_many(updates[i:i + 300])
+        sj.commit()
+    for jr in (JournalReader(sj.db), sj.get_reader()):
+        assert jr.digest_mode == 'skiplist'
+        assert jr.validate_state(1000) == sj.state_digest
+        for uc in (1, 2, 3, 64, 100, 511, 512, 999, 1000):
+            r = jr.get_ssv_log(uc)
+            assert r['proof'][0] == sha3(rlp.encode([r['key'], r['value'],
+                                                     r['prev_update_counter']]))
+            assert evaluate_ssv_log(r['proof']) == sj.state_digest
+            assert len(r['proof']) < 50
+            end = uc + (1000 - uc) / 2
+            r = jr.get_ssv_log(uc, end)
+            assert evaluate_ssv_log(r['proof']) == jr.read_digest(end)
+
+    # the mode is fixed on creation
+    sj = StateJournal(sj.db)
+    assert sj.digest_mode == 'skiplist'
+    try:
+        StateJournal(sj.db, digest_mode='linear')
+    except AssertionError:
+        pass
+    else:
+        assert False, 'digest mode changed'
+
+
+def test_validate_state_parallel(tmpdir):
+    path = str(tmpdir)
+    sj = get_journal(path)
+    sj.update_many(get_updates(1000))
+    sj.commit()
+    progress = []
+    r = validate_state_parallel(sj.db, 1000, processes=2, num_ranges=7,
+                                progress=lambda *a: progress.append(a))
+    assert r == sj.state_digest
+    assert len(progress) == 7
+    assert sorted(p[0] for p in progress)[-1] == 1000
+    assert validate_state_parallel(path, 500, processes=2) == JournalReader(path).read_digest(500)
+
+    # with checkpoints
+    jr = JournalReader(path)
+    checkpoints = [(uc, jr.read_digest(uc)) for uc in (100, 400, 999)]
+    assert validate_state_parallel(path, 1000, processes=2, checkpoints=checkpoints) == r
+    checkpoints[1] = (400, jr.read_digest(401))
+    try:
+        validate_state_parallel(path, 1000, processes=2, checkpoints=checkpoints)
+    except AssertionError:
+        pass
+    else:
+        assert False, 'invalid checkpoint not detected'
+
+
+def test_validate_state_parallel_skiplist(tmpdir):
+    sj = get_journal(str(tmpdir), digest_mode='skiplist')
+    sj.update_many(get_updates(600))
+    sj.commit()
+    assert validate_state_parallel(sj.db, 600, processes=3) == sj.state_digest
+
+
+def test_checkpoints(tmpdir):
+    sj = get_journal(str(tmpdir), checkpoint_interval=100)
+    updates = get_updates(1000)
+    sj.update_many(updates[:450])
+    sj.commit(checkpoint=True)  # block boundary
+    sj.update_many(updates[450:])
+    sj.commit()
+    jr = JournalReader(sj.db)
+    checkpoints = jr.read_checkpoints()
+    assert [c[0] for c in checkpoints] == [100, 200, 300, 400, 450, 500, 600, 700, 800, 900,
+                                           1000]
+    for uc, digest, pos in checkpoints:
+        assert digest == jr.read_digest(uc)
+        assert pos == jr.read_journal_pos(uc)
+    assert jr.nearest_checkpoint(99) == (0, StateJournal.empty_state_digest, 0)
+    assert jr.nearest_checkpoint(460)[0] == 450
+    assert jr.validate_state(1000, trust_checkpoints=True) == sj.state_digest
+    assert validate_state_parallel(sj.db, 1000, processes=2, num_ranges=4) == sj.state_digest
+
+    # startup validation
+    sj = StateJournal(sj.db, checkpoint_interval=100, validate=True)
+
+    # rollback removes checkpoints
+    values = dict((k, sj.get(k)) for k, v in updates)
+    sj.update_many(get_updates(300, num_keys=20))
+    sj.commit()
+    assert sj.update_counter == 1300
+    sj.rollback(1000, verify=True)
+    assert sj.update_counter == 1000
+    assert sj.state_digest == jr.read_digest(1000)
+    assert jr.read_checkpoints() == checkpoints
+    for k, v in values.items():
+        assert sj.get(k) == v
+
+    sj.rollback(420, verify=True)
+    assert [c[0] for c in jr.read_checkpoints()] == [100, 200, 300, 400]
+    assert StateJournal(sj.db, validate=True).state_digest == sj.state_digest
+
+
+def test_memory_journal(tmpdir):
+    for digest_mode in StateJournal.digest_modes:
+        path_a = str(tmpdir.join(digest_mode + '_a'))
+        path_b = str(tmpdir.join(digest_mode + '_b'))
+        sj_a = get_journal(path_a, digest_mode=digest_mode)
+        sj_b = get_journal(path_b, digest_mode=digest_mode)
+        updates = get_updates(400)
+        sj_a.update_many(updates[:100])
+        sj_a.commit()
+        sj_b.update_many(updates)
+        sj_b.commit()
+
+        # two blocks on one branch, a sibling branch
+        block1 = sj_a.fork()
+        assert isinstance(block1, MemoryStateJournal)
+        block1.update_many(updates[100:250])
+        block2 = block1.fork()
+        for k, v in updates[250:]:
+            block2.update(k, v)
+        sibling = sj_a.fork()
+        sibling.update_many(get_updates(30, num_keys=5))
+
+        assert block2.update_counter == 400
+        assert block2.state_digest == sj_b.state_digest
+        for k, v in updates[-50:]:
+            assert block2.get(k) == v
+            assert block2.get_raw(k) == sj_b.get_raw(k)
+        assert sj_a.update_counter == 100  # nothing written
+        assert sibling.update_counter == 130
+        assert sibling.state_digest != block1.state_digest
+
+        # rollback in memory
+        block2.rollback(300)
+        assert block2.state_digest == JournalReader(path_b).read_digest(300)
+        block2.update_many(updates[300:])
+        assert block2.state_digest == sj_b.state_digest
+
+        # finalize the branch
+        assert block2.flush() is sj_a
+        assert sj_a.update_counter == 400
+        assert sj_a.state_digest == sj_b.state_digest
+        assert read_files(path_a) == read_files(path_b)
+
+
+def test_rollback(tmpdir):
+    for digest_mode in StateJournal.digest_modes:
+        path = str(tmpdir.join(digest_mode))
+        sj = get_journal(path, digest_mode=digest_mode, checkpoint_interval=50)
+        snapshots = []
+        for i in range(4):
+            snapshots.append((sj.update_counter, sj.state_digest, dict(
+                (k, sj.get_raw(k)) for k, v in get_updates(100, num_keys=60))))
+            sj.update_many(get_updates(100, num_keys=30 + 10 * i))
+            sj.commit()
+        for uc, digest, values in reversed(snapshots):
+            sj.rollback(uc, verify=True)
+            assert sj.update_counter == uc
+            assert sj.state_digest == digest
+            for k, v in values.items():
+                assert sj.get_raw(k) == v
+        assert os.path.getsize(os.path.join(path, StateJournal.state_journal_fn)) == 0
+        sj = StateJournal(sj.db)
+        assert sj.update_counter == 0
+
+
+def test_rollback_tampered(tmpdir):
+    path = str(tmpdir)
+    sj = get_journal(path)
+    sj.update_many(get_updates(100))
+    sj.commit()
+    jr = sj.get_reader()
+    pos = jr.read_journal_pos(90) - 3  # last byte of the log
+    fn = os.path.join(path, StateJournal.state_journal_fn)
+    data = open(fn).read()
+    open(fn, 'r+').write(data[:pos] + chr(ord(data[pos]) ^ 1) + data[pos + 1:])
+    try:
+        sj.rollback(50)
+    except AssertionError:
+        pass
+    else:
+        assert False, 'tampered journal not detected'
+
+
+def test_segmented_journal(tmpdir):
+    for digest_mode in StateJournal.digest_modes:
+        path_a = str(tmpdir.join(digest_mode + '_a'))
+        path_b = str(tmpdir.join(digest_mode + '_b'))
+        sj_a = get_journal(path_a, digest_mode=digest_mode)
+        sj_b = get_journal(path_b, digest_mode=digest_mode, segment_size=2000)
+        updates = get_updates(500)
+        for i in range(0, 500, 100):
+            sj_a.update_many(updates[i:i + 100])
+            sj_a.commit()
+            for k, v in updates[i:i + 100]:
+                sj_b.update(k, v)
+            sj_b.commit()
+        assert sj_a.state_digest == sj_b.state_digest
+        assert sj_b.segment > 10
+        assert not os.path.exists(os.path.join(path_b, StateJournal.state_journal_fn))
+        for jr in (JournalReader(path_b), sj_b.get_reader()):
+            assert jr.validate_state(500) == sj_b.state_digest
+            for uc in (1, 2, 250, 499, 500):
+                assert jr.read_update(uc) == JournalReader(path_a).read_update(uc)
+        assert validate_state_parallel(path_b, 500, processes=2) == sj_b.state_digest
+
+        # rollback removes segments
+        sj_b.rollback(100)
+        sj_a.rollback(100)
+        assert sj_b.state_digest == sj_a.state_digest
+        assert not os.path.exists(segment_fn(path_b, sj_b.segment + 1))
+        sj_b.update_many(updates[:200])
+        sj_b.commit()
+        sj_b = StateJournal(sj_b.db)
+        assert sj_b.segment_size == 2000
+        assert sj_b.update_counter == 300
+        assert sj_b.get_reader().validate_state(300) == sj_b.state_digest
+
+
+def test_open_segments(tmpdir):
+    import resource
+    sj = get_journal(str(tmpdir), segment_size=1000)
+    sj.update_many(get_updates(3000))
+    sj.commit()
+    assert sj.segment > 200
+    limits = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (150, limits[1]))
+    try:
+        for jr in (JournalReader(sj.db), MmapJournalReader(sj.db)):
+            jr.max_open_segments = 10
+            assert jr.validate_state(3000, use_log_hashes=False) == sj.state_digest
+            assert len(jr._segments) == 10
+            raw = jr.read_raw(1)
+            for uc in range(3000, 0, -7):
+                jr.read_update(uc)
+            assert str(raw[0]) == jr.read_digest(1)  # evicted, still readable
+    finally:
+        resource.setrlimit(resource.RLIMIT_NOFILE, limits)
+
+
+def test_segment_boundaries(tmpdir):
+    # fixed size entries which fill segments exactly
+    updates = [(sha3(str(i)), int_to_big_endian(2**24 + i)) for i in range(100)]
+    entry_length = 32 + len(rlp.encode([updates[0][0], updates[0][1], ''])) + 2
+    sj = get_journal(str(tmpdir), segment_size=3 * entry_length)
+    sj.update_many(updates)
+    sj.commit()
+    assert sj.segment == 33
+    jr = sj.get_reader()
+    assert jr.validate_state(100) == sj.state_digest
+    assert jr.read_journal_pos(99) == 33 * 3 * entry_length
+    sj.rollback(99)
+    assert sj.segment == 32
+    sj.update_many(updates[99:])
+    sj.commit()
+    assert sj.segment == 33
+    assert jr.validate_state(100) == sj.state_digest
+
+
+def test_oversized_entry(tmpdir):
+    path = str(tmpdir)
+    sj = get_journal(path, segment_size=2**16, history=True)
+    sj.update_many(get_updates(10))
+    sj.commit()
+    state = (sj.update_counter, sj.state_digest, sj.journal_pos, list(sj.db.range_iter()))
+    for update in (lambda: sj.update('big', 'x' * 70000),
+                   lambda: sj.append_log(rlp.encode(['big', 'x' * 70000, '']))):
+        try:
+            update()
+        except ValueError:
+            pass
+        else:
+            assert False, 'entry larger than the segment_size not rejected'
+    assert (sj.update_counter, sj.state_digest, sj.journal_pos,
+            list(sj.db.range_iter())) == state
+    sj.update('big', 'x' * 60000)
+    sj.commit()
+    sj = StateJournal(sj.db, validate=True)
+    assert sj.update_counter == 11
+    assert sj.get_reader().validate_state(11) == sj.state_digest
+    assert sj.get('big') == 'x' * 60000
+
+
+def test_large_entries(tmpdir):
+    updates = get_updates(300)
+    for i in (0, 10, 11, 150, 299):
+        updates[i] = (updates[i][0], str(i) * 40000)  # up to 120KB
+    for segment_size in (None, 2**20):
+        sj = get_journal(str(tmpdir.join(str(segment_size))), segment_size=segment_size,
+                         digest_mode='skiplist')
+        sj.update_many(updates[:200])
+        sj.commit()
+        for k, v in updates[200:]:
+            sj.update(k, v)
+        sj.commit()
+        for jr in (JournalReader(sj.db), sj.get_reader()):
+            assert jr.validate_state(300) == sj.state_digest
+            for i in (0, 10, 11, 150, 299):
+                assert jr.read_update(i + 1)['value'] == updates[i][1]
+            assert jr.read_update(12)['value'] == updates[11][1]
+            r = jr.get_ssv_log(11)
+            assert evaluate_ssv_log(r['proof']) == sj.state_digest
+        sj.rollback(11)
+        assert sj.get(updates[10][0]) == updates[10][1]
+        sj.rollback(0)
+        assert sj.get(updates[10][0]) == ''
+
+
+def test_archive_segments(tmpdir):
+    path = str(tmpdir)
+    sj = get_journal(path, segment_size=4000, digest_mode='skiplist')
+    updates = get_updates(1000)
+    updates[500] = (updates[500][0], 'x' * 3000)
+    sj.update_many(updates)
+    sj.commit()
+    jr = sj.get_reader()
+    expected = [JournalReader(path).read_update(uc) for uc in range(1, 1001)]
+
+    stats = sj.archive(600, block_size=1000)
+    last_segment = jr.segment_of(jr.read_journal_pos(600))[0]
+    assert stats['segments'] == last_segment
+    assert stats['archived_bytes'] < stats['raw_bytes']
+    assert stats['blocks'] > stats['segments']
+    for segment in range(last_segment):
+        assert not os.path.exists(segment_fn(path, segment))
+    assert os.path.exists(segment_fn(path, last_segment))
+
+    jr.remap()
+    for r in (JournalReader(path), jr):
+        assert [r.read_update(uc) for uc in range(1, 1001)] == expected
+        assert r.validate_state(1000) == sj.state_digest
+        assert evaluate_ssv_log(r.get_ssv_log(3)['proof']) == sj.state_digest
+
+    # archiving in the background, continue writing
+    sj.archive(900, block_size=1000, background=True).join()
+    assert sj.archive(900)['segments'] == 0
+    sj.update_many(updates[:100])
+    sj.commit()
+    sj = StateJournal(sj.db)
+    assert sj.update_counter == 1100
+    assert validate_state_parallel(path, 1100, processes=2) == sj.state_digest
+    sj.rollback(1000)
+    try:
+        sj.rollback(10)
+    except AssertionError:
+        pass
+    else:
+        assert False, 'rollback into archived segments'
+
+
+def test_durability_modes(tmpdir, monkeypatch):
+    updates = get_updates(300)
+    files = []
+    for durability in ('none', 'flush', 'fsync', 'group'):
+        path = str(tmpdir.join(durability))
+        sj = get_journal(path, durability=durability, group_commit_blocks=4, segment_size=2000)
+        synced = []
+        monkeypatch.setattr(os, 'fsync', lambda fd: synced.append(
+            os.path.basename(os.readlink('/proc/self/fd/%d' % fd))))
+        for block in range(3):
+            sj.update_many(updates[block * 100:(block + 1) * 100])
+            sj.commit()
+        if durability == 'group':
+            # only finished segments are synced until the group is due or synced
+            assert StateJournal.state_journal_index_fn not in synced
+            sj.sync()
+        if durability in ('fsync', 'group'):
+            # the journal is always synced before the index
+            index_synced = synced.index(StateJournal.state_journal_index_fn)
+            assert synced.index(os.path.basename(segment_fn('', 2))) < index_synced
+        else:
+            assert not synced
+        monkeypatch.undo()
+        assert sj.get_reader().validate_state(300) == sj.state_digest
+        files.append([open(os.path.join(path, fn)).read() for fn in sorted(os.listdir(path))
+                      if fn.startswith(StateJournal.state_journal_fn)])
+    assert files.count(files[0]) == len(files)
+
+
+def test_db_durability(tmpdir):
+    "the db syncs according to its own durability, unless the journal requires a sync"
+    class RecordSync(object):
+        def __init__(self, db):
+            self.db, self.syncs = db, []
+
+        def Write(self, batch, sync):
+            self.syncs.append(sync)
+            self.db.Write(batch, sync=sync)
+
+        def __getattr__(self, name):
+            return getattr(self.db, name)
+    for db_durability, durability, expected in (('fsync', 'flush', True),
+                                                ('flush', 'flush', False),
+                                                ('flush', 'fsync', True)):
+        db = LevelDB(str(tmpdir.join(db_durability + durability)), durability=db_durability)
+        db.db = RecordSync(db.db)
+        sj = StateJournal(db, durability=durability)
+        sj.update_many(get_updates(10))
+        sj.commit()
+        assert db.db.syncs == [expected]
+
+
+def test_pipelined(tmpdir):
+    updates = get_updates(3000)
+    files = []
+    for pipelined in (False, True):
+        path = str(tmpdir.join(str(pipelined)))
+        sj = get_journal(path, pipelined=pipelined, pipeline_queue_size=2,
+                         segment_size=20000, checkpoint_interval=700)
+        for block in range(3):
+            sj.update_many(updates[block * 1000:(block + 1) * 1000])
+            sj.commit(checkpoint=True)
+            assert sj.get_reader().validate_state(sj.update_counter) == sj.state_digest
+            assert not sj.db.uncommitted
+        writer = sj._writer
+        sj.close()
+        assert (writer is not None) == pipelined and not (writer and writer.is_alive())
+        files.append([open(os.path.join(path, fn)).read() for fn in sorted(os.listdir(path))
+                      if fn.startswith(StateJournal.state_journal_fn)])
+    assert files[0] == files[1]
+
+
+def test_pipelined_write_error(tmpdir):
+    sj = get_journal(str(tmpdir), pipelined=True)
+
+    def fail(*args):
+        raise IOError('disk full')
+    sj._write_files = fail
+    sj.update_many(get_updates(2500))  # hands off two chunks
+    try:
+        sj.commit()
+        assert False
+    except IOError as e:
+        assert str(e) == 'disk full'
+    try:  # the writer stays stopped
+        sj.commit()
+        assert False
+    except IOError:
+        pass
+    writer = sj._writer
+    try:
+        sj.close()
+        assert False
+    except IOError:
+        pass
+    assert not writer.is_alive()
+
+
+def test_iter_prefix(tmpdir):
+    sj = get_journal(str(tmpdir))
+    sj.update_many([('a1', '1'), ('a2', '2'), ('b1', '3')])
+    sj.commit()
+    sj.update_many([('a3', '4'), ('a1', ''), ('a2', '5')])
+    # uncommitted updates and deletes are merged
+    assert list(sj.iter_prefix('a')) == [('a2', '5'), ('a3', '4')]
+    fork = sj.fork()
+    fork.update_many([('a0', '6'), ('a3', '')])
+    assert list(fork.iter_prefix('a')) == [('a0', '6'), ('a2', '5')]
+    sj.commit()
+    assert list(sj.iter_prefix('a')) == [('a2', '5'), ('a3', '4')]
+    assert list(sj.iter_prefix('c')) == []
+
+
+def test_get_at(tmpdir):
+    keys = [sha3(str(i)) for i in range(5)]
+    updates = [(keys[i % 5] if i % 3 else keys[0], int_to_big_endian(i + 1)) for i in range(400)]
+    snapshots = [dict()]
+    for key, value in updates:
+        snapshots.append(dict(snapshots[-1], **{key: value}))
+    for history in (False, True):
+        path = str(tmpdir.join(str(history)))
+        sj = get_journal(path, history=history, durability='group', group_commit_blocks=2)
+        sj.update_many(updates[:150])
+        sj.commit()  # deferred
+        sj.update_many(updates[150:300])
+        sj.commit()
+        sj.update_many(updates[300:])  # uncommitted
+        for uc in range(0, 401, 7):
+            assert sj.get_at_many(keys, uc) == [snapshots[uc].get(k, '') for k in keys]
+        # reads do not commit the block
+        assert len(sj.db.uncommitted) == 5
+        assert os.path.getsize(os.path.join(path, StateJournal.state_journal_index_fn)) == 1200
+        fork = sj.fork()
+        fork.update(keys[1], 'x')
+        assert fork.get_at(keys[1], 401) == 'x'
+        assert fork.get_at(keys[1], 400) == sj.get(keys[1])
+        assert fork.get_at(keys[1], 10) == snapshots[10][keys[1]]
+        # the history continues through deletes and re-creations
+        sj.update_many([(keys[2], ''), (keys[2], 'y'), (keys[3], '')])
+        deletes = snapshots + [dict(snapshots[400], **{keys[2]: ''})]
+        deletes.append(dict(deletes[401], **{keys[2]: 'y'}))
+        deletes.append(dict(deletes[402], **{keys[3]: ''}))
+        for uc in (10, 400, 401, 402, 403):
+            assert sj.get_at_many(keys, uc) == [deletes[uc][k] for k in keys]
+        assert sj.get_raw(keys[3]) == ('', 403)
+        sj.rollback(401)  # restores the delete
+        assert sj.get_raw(keys[2]) == ('', 401)
+        assert sj.get_at(keys[2], 400) == snapshots[400][keys[2]]
+        sj.rollback(350)
+        assert sj.get_at(keys[0], 200) == snapshots[200][keys[0]]
+
+
+def test_history_skips(tmpdir):
+    # one key with a long history, added to an existing journal
+    sj = get_journal(str(tmpdir))
+    sj.update_many(('k', int_to_big_endian(i + 1)) for i in range(1000))
+    sj.commit()
+    sj = StateJournal(sj.db, history=True)
+    sj.update_many(('k', int_to_big_endian(i + 1)) for i in range(1000, 2000))
+    sj.commit()
+    jr = sj.get_reader()
+    reads = []
+    read_history = jr.read_history
+    jr.read_history = lambda uc: reads.append(uc) or read_history(uc)
+    for uc in (1, 2, 500, 1001, 1999):
+        del reads[:]
+        assert sj.get_at('k', uc) == int_to_big_endian(uc)
+        assert len(reads) < 40
+    assert jr.read_history(2000) == (2000, 1999, jr.read_history(2000)[2])
+
+
+def test_rebuild_state_parallel(tmpdir):
+    path = str(tmpdir.join('db'))
+    sj = get_journal(path, checkpoint_interval=100)
+    sj.update_many(get_updates(1000))
+    sj.commit()
+    expected = list(sj.db.range_iter())
+    # lost and stale values
+    for i, (key, value) in enumerate(expected):
+        if i % 2:
+            sj.db.delete(key)
+    sj.db.put('stale', rlp.encode(['x', 1]))
+    sj.db.put(sha3('2'), rlp.encode(['x', 1]))  # deleted by update 952
+    sj.db.commit()
+    progress = []
+    num_keys = rebuild_state_parallel(sj.db, processes=2, num_ranges=3,
+                                      progress=lambda *args: progress.append(args[:2]))
+    assert num_keys == 50
+    assert sorted(progress) == [(1, 3), (2, 3), (3, 3)]
+    assert list(sj.db.range_iter()) == sorted(expected + [('stale', rlp.encode(['x', 1]))])
+
+
+def test_pruned_ancestors():
+    for uc in (1, 2, 63, 64, 65, 300, 1000, 1023, 4097):
+        expected = set(distant_ancestor(n) for n in range(uc + 1, 2 * uc + 200))
+        assert pruned_ancestors(uc) == sorted(a for a in expected if 0 < a < uc)
+
+
+def test_prune_before(tmpdir):
+    updates = get_updates(700)
+    for digest_mode in StateJournal.digest_modes:
+        for segment_size in (None, 2000):
+            name = '%s_%s' % (digest_mode, segment_size)
+            path = str(tmpdir.join(name))
+            ref = get_journal(str(tmpdir.join(name + '_ref')), digest_mode=digest_mode)
+            sj = get_journal(path, digest_mode=digest_mode, segment_size=segment_size,
+                             checkpoint_interval=100, history=True)
+            for journal in (ref, sj):
+                journal.update_many(updates[:600])
+                journal.commit()
+            size = sum(os.path.getsize(os.path.join(path, fn)) for fn in os.listdir(path))
+            sj.prune_before(301)
+            assert sum(os.path.getsize(os.path.join(path, fn))
+                       for fn in os.listdir(path)) < size
+            if segment_size:
+                assert not os.path.exists(segment_fn(path, 0))
+            assert sj.update_counter == 600
+            for jr in (JournalReader(path), MmapJournalReader(path), sj.get_reader()):
+                assert jr.update_counter() == 600
+                assert jr.validate_state(600) == sj.state_digest
+                assert jr.validate_state(600, use_log_hashes=False) == sj.state_digest
+                assert jr.read_update(301) == JournalReader(ref.db).read_update(301)
+                assert jr.read_digest(300) == ref.get_reader().read_digest(300)
+                if digest_mode == 'skiplist':
+                    r = jr.get_ssv_log(301)
+                    assert evaluate_ssv_log(r['proof']) == sj.state_digest
+                else:
+                    hash_chain = jr.get_ssv(301)['hash_chain']
+                    assert reduce(lambda s, h: sha3(s + h), hash_chain) == sj.state_digest
+                for uc in (1, 299, 300):
+                    try:
+                        jr.read_update(uc)
+                    except IOError:
+                        pass
+                    else:
+                        assert False, 'pruned update'
+            assert validate_state_parallel(path, 600, processes=2) == sj.state_digest
+            assert sj.get_at(sha3('10'), 350) == ref.get_at(sha3('10'), 350)
+            try:
+                sj.get_at(sha3('10'), 305)  # written by update 260
+            except IOError as e:
+                assert str(e) == 'update_counter 260 is pruned'
+            else:
+                assert False, 'pruned value'
+
+            # reopen, continue, reopen and rollback
+            journal_pos = sj.journal_pos
+            sj = StateJournal(sj.db, history=True)
+            assert sj.journal_pos == journal_pos
+            for journal in (ref, sj):
+                journal.update_many(updates[600:])
+                journal.commit()
+            assert sj.state_digest == ref.state_digest
+            sj = StateJournal(sj.db, history=True)
+            assert sj.update_counter == 700
+            assert sj.state_digest == ref.state_digest
+            assert JournalReader(path).read_update(650) == JournalReader(ref.db).read_update(650)
+            assert sj.get_reader().validate_state(700) == sj.state_digest
+            for journal in (ref, sj):
+                journal.rollback(400)
+            assert sj.state_digest == ref.state_digest
+            assert list(sj.db.range_iter()) == list(ref.db.range_iter())
+            try:
+                sj.rollback(200)
+            except AssertionError:
+                pass
+            else:
+                assert False, 'rollback to a pruned update'
+
+            # prune again, interrupted before the new anchor was written
+            sj.prune_before(351)
+            assert sj.get_reader().validate_state(400) == sj.state_digest
+            fn = os.path.join(path, StateJournal.state_journal_log_hashes_fn)
+            open(fn + '.pruned', 'w').write('garbage')
+            finish_prune(path)
+            assert not os.path.exists(fn + '.pruned')
+            assert JournalReader(path).validate_state(400) == sj.state_digest
+
+
+def test_stats(tmpdir):
+    sj = get_journal(str(tmpdir.join('plain')))
+    assert 'get_raw' not in sj.__dict__
+    assert 'timers' not in sj.stats()
+    sj = get_journal(str(tmpdir.join('instrumented')), digest_mode='skiplist',
+                     instrumented=True)
+    sj.update_many(get_updates(100))
+    sj.commit()
+    sj.sync()
+    s = sj.stats()
+    assert s['update_counter'] == 100
+    assert s['timers']['get_raw']['calls'] == 100
+    assert s['timers']['sha3']['calls'] == 100
+    assert s['timers']['rlp']['calls'] > 100  # logs and stored values
+    assert s['counters']['bytes.journal'] == sj.journal_pos
+    assert s['counters']['bytes.journal_index'] == 400
+    assert sum(c for _, c in s['histograms']['flush']) >= 1
+    sj.get_reader().read_update(50)
+    assert sj.stats()['reader']['timers']['read_raw']['calls'] >= 1
+    assert sj.fork().stats()['update_counter'] == 100
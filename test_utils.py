@@ -0,0 +1,49 @@
+import utils
+from utils import get_pareto, generate_workload, _get_alpha_python
+
+
+def cum_fraction(lower_x, alpha, num_samples=10000):
+    vals = [utils.pareto(i * utils.upper_x / num_samples, alpha) for i in range(num_samples)]
+    return sum(vals[:int(lower_x * num_samples)]) / sum(vals)
+
+
+def test_get_alpha():
+    assert _get_alpha_python(0.5, 0.5) == utils.get_alpha(0.5, 0.5) == 0.1
+    for lower_x, cumulate_for in ((0.2, 0.8), (0.4, 0.6)):
+        alpha = utils.get_alpha(lower_x, cumulate_for)
+        # the first 1% step above cumulate_for
+        assert cum_fraction(lower_x, alpha) > cumulate_for
+        assert cum_fraction(lower_x, alpha / 1.01) <= cumulate_for
+        assert utils.get_alpha(lower_x, cumulate_for) == alpha
+
+
+def test_pareto_table():
+    P = get_pareto(806., 156, 317)
+    for x in (0, 1, 100, 316, 317, 1000):
+        assert abs(P(x) - P._pareto(x)) < 1e-9 * P.max_v
+    assert abs(P(10.) - P._pareto(10.)) < 1e-12
+    assert list(P.sample(range(400))) == [int(P(x)) for x in range(400)]
+
+
+def test_pareto_without_numpy(monkeypatch):
+    P = get_pareto(806., 156, 317)
+    monkeypatch.setattr(utils, 'numpy', None)
+    Q = get_pareto(806., 156, 317)
+    assert isinstance(Q.table, list)
+    assert Q.sample(range(400)) == list(P.sample(range(400)))
+
+
+def test_generate_workload():
+    config = dict(txs_per_block=get_pareto(806., 156, 317),
+                  num_accounts=100,
+                  contract_storage_slots=get_pareto(806., 10000, 507),
+                  storage_reads=get_pareto(806., 100, 2327),
+                  num_blocks=50)
+    w = generate_workload(config)
+    assert list(w['txs_per_block']) == [int(config['txs_per_block'](i)) for i in range(50)]
+    assert len(w['storage_slots']) == 101
+    assert len(w['storage_reads']) == sum(w['txs_per_block'])
+    a, b = generate_workload(config, seed=1), generate_workload(config, seed=1)
+    for k in w:
+        assert list(a[k]) == list(b[k])
+    assert list(a['txs_per_block']) != list(generate_workload(config, seed=2)['txs_per_block'])
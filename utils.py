@@ -1,4 +1,10 @@
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
 def pareto(x, alpha=.1, Xm=1.):
     x += 1
     assert alpha > 0
@@ -10,16 +16,57 @@ def pareto(x, alpha=.1, Xm=1.):
 
 upper_x = 0.01
 
+class Pareto(object):
+    """
+    pareto function repeating every max_x, scaled to max_v at x=0
+    with a lookup table for integer x
+    """
+
+    def __init__(self, alpha, max_v, max_x=1000):
+        self.alpha, self.max_v, self.max_x = alpha, max_v, max_x
+        self.norm = max_v / pareto(0., alpha)
+        if numpy is not None:
+            x = numpy.arange(max_x) * (upper_x / max_x)
+            self.table = alpha * (x + 1) ** -(alpha + 1) * self.norm  # see pareto
+        else:
+            self.table = [self._pareto(x) for x in range(max_x)]
+
+    def _pareto(self, x):
+        x = x % self.max_x
+        x *= upper_x / self.max_x
+        return pareto(x, self.alpha) * self.norm
+
+    def __call__(self, x):
+        if isinstance(x, (int, long)):
+            return self.table[x % self.max_x]
+        return self._pareto(x)
+
+    def sample(self, xs):
+        "returns the values at the integer positions xs as an int array (list w/o numpy)"
+        if numpy is not None:
+            return self.table[numpy.asarray(xs) % self.max_x].astype(int)
+        return [int(self.table[x % self.max_x]) for x in xs]
+
+
 def get_pareto(alpha, max_v, max_x=1000):
-    norm = max_v / pareto(0., alpha)
-    def _pareto(x):
-        x = x % max_x
-        x *= upper_x / max_x
-        return pareto(x, alpha) * norm
-    return _pareto
+    return Pareto(alpha, max_v, max_x)
+
+
+_alphas = dict()  # (lower_x, cumulate_for) > alpha
 
 
 def get_alpha(lower_x=0.20, cumulate_for=.80):
+    """
+    returns the smallest alpha (increased in 1% steps) for which
+    the lower_x fraction of the samples cumulates more than cumulate_for
+    """
+    if (lower_x, cumulate_for) not in _alphas:
+        f = _get_alpha_numpy if numpy is not None else _get_alpha_python
+        _alphas[(lower_x, cumulate_for)] = f(lower_x, cumulate_for)
+    return _alphas[(lower_x, cumulate_for)]
+
+
+def _get_alpha_python(lower_x, cumulate_for):
     num_samples = 10000
     i_norm = upper_x / num_samples
     alpha = 0.1
@@ -32,6 +79,50 @@ def get_alpha(lower_x=0.20, cumulate_for=.80):
     return alpha
 
 
+def _get_alpha_numpy(lower_x, cumulate_for, chunk_size=64):
+    "evaluates chunk_size alpha steps at once"
+    num_samples = 10000
+    log_x = numpy.log(numpy.arange(num_samples) * (upper_x / num_samples) + 1)
+    lower = int(lower_x * num_samples)
+    alpha = 0.1
+    while True:
+        alphas = [alpha]
+        for i in range(chunk_size - 1):
+            alphas.append(alphas[-1] * 1.01)
+        alphas = numpy.array(alphas)
+        # the alpha factor of pareto cancels out
+        vals = numpy.exp(-(alphas[:, None] + 1) * log_x)
+        cum_fraction = vals[:, :lower].sum(axis=1) / vals.sum(axis=1)
+        found = numpy.nonzero(cum_fraction > cumulate_for)[0]
+        if len(found):
+            return float(alphas[found[0]])
+        alpha = alphas[-1] * 1.01
+
+
+def generate_workload(config, num_blocks=None, seed=None):
+    """
+    returns the workload of the chainmock config as int arrays (lists w/o numpy):
+        txs_per_block: per block number
+        storage_slots: per account number (0..num_accounts)
+        storage_reads: per tx number
+    seed: None evaluates the pareto functions at the block, account and tx numbers,
+        otherwise at positions drawn with numpy.random.RandomState(seed)
+    """
+    num_blocks = num_blocks or config['num_blocks']
+    if seed is None:
+        positions = range
+    else:
+        assert numpy is not None, 'seeded workloads require numpy'
+        rnd = numpy.random.RandomState(seed)
+        positions = lambda n: rnd.randint(0, 2**31, n)
+    txs_per_block = config['txs_per_block'].sample(positions(num_blocks))
+    num_txs = int(sum(txs_per_block))
+    return dict(txs_per_block=txs_per_block,
+                storage_slots=config['contract_storage_slots'].sample(
+                    positions(config['num_accounts'] + 1)),
+                storage_reads=config['storage_reads'].sample(positions(num_txs)))
+
+
 
 
 if __name__ == '__main__':